@@ -0,0 +1,73 @@
+"""Quality and speed of the get_weight density ratio estimators against the MLP.
+
+Source features are N(0, I) and target features N(mu, I), so the true importance weight of a
+validation sample is exp(x . mu - |mu|^2 / 2). For every estimator the benchmark reports the
+fit time, the Spearman correlation of its weights with the true ones, and how far the DEV risk
+of a synthetic error vector computed with its weights is from the risk with the true weights.
+
+    python -m benchmarks.estimators [--n 2000] [--d 256] [--shift 0.5] [--estimators mlp logistic ulsif ...]
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+from scipy.stats import spearmanr
+
+import dev
+
+CONFIGS = {
+    'mlp': {'estimator': 'mlp'},
+    'ensemble': {'estimator': 'ensemble'},
+    'logistic': {'estimator': 'logistic'},
+    'ulsif': {'estimator': 'ulsif'},
+    'kliep': {'estimator': 'kliep'},
+    'logistic+pca': {'estimator': 'logistic', 'reduce': 'pca'},
+    'logistic+random': {'estimator': 'logistic', 'reduce': 'random'},
+    'ulsif+pca': {'estimator': 'ulsif', 'reduce': 'pca'},
+}
+
+
+def make_problem(n, d, shift, seed=0):
+    rng = np.random.RandomState(seed)
+    mu = np.zeros(d)
+    mu[:max(1, d // 16)] = shift
+    source = rng.randn(n, d).astype(np.float32)
+    target = (rng.randn(n, d) + mu).astype(np.float32)
+    validation = rng.randn(n // 2, d).astype(np.float32)
+    true_weight = np.exp(validation.dot(mu) - mu.dot(mu) / 2).reshape(-1, 1)
+    # errors that depend on the shifted directions, so the weighting changes the risk
+    error = (rng.rand(len(validation)) < 1 / (1 + np.exp(-validation[:, 0]))).astype(np.float64).reshape(-1, 1)
+    return source, target, validation, true_weight, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=2000)
+    parser.add_argument('--d', type=int, default=256)
+    parser.add_argument('--shift', type=float, default=0.5)
+    parser.add_argument('--n-components', type=int, default=64)
+    parser.add_argument('--estimators', nargs='+', default=sorted(CONFIGS))
+    args = parser.parse_args()
+
+    source, target, validation, true_weight, error = make_problem(args.n, args.d, args.shift)
+    true_risk = dev.get_dev_risk(true_weight, error)
+    print('n={} d={} shift={} true DEV risk {:.4f}'.format(args.n, args.d, args.shift, true_risk))
+    print('{:<16} {:>9} {:>9} {:>11}'.format('estimator', 'seconds', 'spearman', 'risk error'))
+    for name in args.estimators:
+        config = dict(CONFIGS[name])
+        if 'reduce' in config:
+            config['n_components'] = args.n_components
+        np.random.seed(0)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            weight = dev.get_weight(source, target, validation, **config)
+        seconds = time.perf_counter() - start
+        rho = spearmanr(weight.ravel(), true_weight.ravel())[0]
+        risk_error = abs(dev.get_dev_risk(weight, error) - true_risk)
+        print('{:<16} {:9.2f} {:9.3f} {:11.4f}'.format(name, seconds, rho, risk_error))
+
+
+if __name__ == '__main__':
+    main()
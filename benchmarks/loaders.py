@@ -0,0 +1,72 @@
+"""Images/sec of every data_list loader backend on a directory of sample images.
+
+Every backend decodes each image and resizes it with pre_process.ResizeImage, which is
+the work a loader does before the crop in every pipeline.
+
+    python -m benchmarks.loaders IMAGE_DIR [--resize 256] [--repeat 3] [--backends pil pil_draft accimage]
+"""
+import argparse
+import os
+import time
+
+import data_list
+import pre_process as prep
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp')
+
+
+def list_images(image_dir):
+    paths = []
+    for root, _, files in os.walk(image_dir):
+        for name in sorted(files):
+            if name.lower().endswith(IMG_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return paths
+
+
+def bench_loader(loader, paths, resize_size, repeat):
+    """
+    Best images/sec over repeat passes of loader + ResizeImage over paths
+    :param loader: a loader callable
+    :param paths: image paths
+    :param resize_size:
+    :param repeat: number of passes, the best one is reported
+    :return:
+    """
+    resize = prep.ResizeImage(resize_size)
+    best = 0.0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            resize(loader(path))
+        best = max(best, len(paths) / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image_dir')
+    parser.add_argument('--resize', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--limit', type=int, default=None, help='use at most this many images')
+    parser.add_argument('--backends', nargs='+', default=['pil', 'pil_draft', 'accimage'])
+    args = parser.parse_args()
+
+    paths = list_images(args.image_dir)[:args.limit]
+    if len(paths) == 0:
+        raise RuntimeError('Found 0 images in ' + args.image_dir)
+    print('{} images, resize {}'.format(len(paths), args.resize))
+    baseline = None
+    for name in args.backends:
+        loader = data_list.get_loader(name, size=args.resize)
+        try:
+            rate = bench_loader(loader, paths, args.resize, args.repeat)
+        except ImportError as e:
+            print('{:<12} unavailable ({})'.format(name, e))
+            continue
+        baseline = baseline or rate
+        print('{:<12} {:10.1f} img/s  {:5.2f}x'.format(name, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
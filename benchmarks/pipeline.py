@@ -0,0 +1,255 @@
+"""Timings of the DEV pipeline on synthetic data, saved as JSON and compared against a baseline.
+
+Features are Gaussian, the target shifted away from the source, with labels spread evenly over
+the classes. Every case reports its best time over --repeat runs and its own memory: how far the
+resident set grew above where it started during the timed runs (Linux, which can reset the peak of
+a process) and the tracemalloc peak of one further untimed run. The end-to-end case writes small
+noisy JPEGs to a temporary directory and runs cross_validation_loss with a tiny CPU network
+returning (feature, predict_score), whose head is fitted to the colour of every class so the
+pseudolabels cover all of them.
+
+    python -m benchmarks.pipeline [--n 4000] [--d 64] [--classes 4] [--output run.json]
+    python -m benchmarks.pipeline --baseline run.json [--tolerance 0.2]
+
+With --baseline, cases more than --tolerance slower than the baseline, or using more than
+--memory-tolerance (plus --memory-slack MB) more memory, are listed and the exit status is 1.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+import data_list
+import dev
+import pre_process as prep
+
+
+class TinyNetwork(nn.Module):
+    """Stand-in for a backbone and classifier: average pooled pixels, a linear feature and a linear head."""
+
+    def __init__(self, d, class_num):
+        super(TinyNetwork, self).__init__()
+        self.pool = nn.AdaptiveAvgPool2d(4)
+        self.feature = nn.Linear(3 * 4 * 4, d)
+        self.head = nn.Linear(d, class_num)
+
+    def forward(self, x):
+        feature = self.feature(self.pool(x).flatten(1))
+        return feature, self.head(feature)
+
+
+MEMORY_METRICS = ('rss_peak_mb', 'alloc_peak_mb')
+
+
+def _status_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 1024.0
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process to its current RSS, and return the latter in MB; None if unsupported."""
+    try:
+        # 5 resets VmHWM, the high-water mark getrusage also reports, Linux 4.0+
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return _status_mb('VmRSS')
+    except (IOError, OSError, TypeError):
+        return None
+
+
+def make_features(n, d, class_num, shift, seed):
+    rng = np.random.RandomState(seed)
+    source = rng.randn(n, d).astype(np.float32)
+    target = (rng.randn(n // 2, d) + shift).astype(np.float32)
+    validation = rng.randn(n // 2, d).astype(np.float32)
+    labels = np.arange(n) % class_num
+    return source, target, validation, labels
+
+
+def make_images(directory, n, class_num, size, seed):
+    """Write n noisy JPEGs with a colour per class and return their "path label" lines."""
+    rng = np.random.RandomState(seed)
+    colours = np.random.RandomState(0).randint(32, 224, size=(class_num, 3))
+    lines = []
+    for i in range(n):
+        path = os.path.join(directory, '{:06d}.jpg'.format(i))
+        pixels = colours[i % class_num] + rng.randint(-32, 33, size=(size, size, 3))
+        Image.fromarray(pixels.astype(np.uint8)).save(path, quality=90)
+        lines.append('{} {}\n'.format(path, i % class_num))
+    return lines
+
+
+def fit_head(network, image_lines, class_num, image_size, batch_size):
+    """Least squares fit of the head on the features of image_lines, so the pseudolabels cover every class."""
+    feature = dev.extract_features(network, image_lines, prep.image_test(image_size, image_size * 7 // 8),
+                                   batch_size)
+    design = np.concatenate((feature, np.ones((len(feature), 1), dtype=np.float32)), axis=1)
+    one_hot = np.eye(class_num, dtype=np.float32)[data_list.list_labels(image_lines)]
+    solution = np.linalg.lstsq(design, one_hot, rcond=None)[0]
+    with torch.no_grad():
+        network.head.weight.copy_(torch.from_numpy(solution[:-1].T))
+        network.head.bias.copy_(torch.from_numpy(solution[-1]))
+
+
+def bench(fn, repeat):
+    """
+    Best wall time of repeat calls of fn, with its stdout discarded, and the memory fn itself takes
+    :param fn: callable without arguments
+    :param repeat:
+    :return: dict of seconds, rss_peak_mb (growth of the RSS above its level before the runs, None where the
+    peak cannot be reset) and alloc_peak_mb (tracemalloc peak of one more run, kept out of the timings)
+    """
+    best = float('inf')
+    rss_start = reset_peak_rss()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        best = min(best, time.perf_counter() - start)
+    rss_peak = None if rss_start is None else max(0.0, _status_mb('VmHWM') - rss_start)
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            fn()
+        alloc_peak = tracemalloc.get_traced_memory()[1] / 2.0 ** 20
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'rss_peak_mb': rss_peak, 'alloc_peak_mb': alloc_peak}
+
+
+def run(args):
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    source, target, validation, labels = make_features(args.n, args.d, args.classes, args.shift, args.seed)
+    error = (np.random.rand(len(validation), 1) < 0.3).astype(np.float64)
+    weight = np.random.rand(len(validation), 1)
+    lines = ['/data/images/{:08d}.jpg {}\n'.format(i, label) for i, label in enumerate(labels)]
+    results = {}
+
+    def case(name, fn):
+        results[name] = bench(fn, args.repeat)
+        rss_peak = results[name]['rss_peak_mb']
+        print('{:<28} {:10.4f} s {:>9} MB rss {:9.1f} MB alloc'.format(
+            name, results[name]['seconds'], '-' if rss_peak is None else '{:.1f}'.format(rss_peak),
+            results[name]['alloc_peak_mb']))
+
+    case('get_dev_risk', lambda: dev.get_dev_risk(weight, error))
+    case('random_select_src', lambda: dev.random_select_src(source, target))
+    case('make_dataset', lambda: data_list.make_dataset(lines, None))
+    for estimator in args.estimators:
+        case('get_weight[{}]'.format(estimator),
+             lambda: dev.get_weight(source, target, validation, decays=args.decays, estimator=estimator))
+
+    directory = tempfile.mkdtemp()
+    try:
+        list_path = os.path.join(directory, 'source.txt')
+        with open(list_path, 'w') as f:
+            f.writelines(lines)
+        case('split_set', lambda: data_list.split_set(list_path, args.classes))
+
+        image_lines = make_images(directory, args.images, args.classes, args.image_size, args.seed)
+        with open(list_path, 'w') as f:
+            f.writelines(image_lines)
+        target_path = os.path.join(directory, 'target.txt')
+        with open(target_path, 'w') as f:
+            f.writelines(make_images(tempfile.mkdtemp(dir=directory), args.images // 2, args.classes,
+                                     args.image_size, args.seed + 1))
+        src_cls_list, val_cls_list = data_list.split_set(list_path, args.classes)
+        network = TinyNetwork(args.d, args.classes).eval()
+        fit_head(network, image_lines, args.classes, args.image_size, args.batch_size)
+        crop_size = args.image_size * 7 // 8
+        case('cross_validation_loss', lambda: dev.cross_validation_loss(
+            network, network, src_cls_list, target_path, val_cls_list, args.classes, args.image_size, crop_size,
+            args.batch_size, weight_kwargs={'decays': args.decays, 'estimator': args.e2e_estimator}))
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(results, baseline, tolerance, memory_tolerance=0.2, memory_slack=1.0):
+    """
+    Print the speed and memory of every case relative to the baseline
+    :param tolerance: allowed fractional slowdown
+    :param memory_tolerance: allowed fractional growth of rss_peak_mb and alloc_peak_mb
+    :param memory_slack: MB allowed on top of memory_tolerance, so cases using next to no memory are not flagged
+    for noise
+    :return: names of the cases more than tolerance slower than the baseline, and "case (metric)" of the cases
+    using more memory
+    """
+    regressions = []
+    print('{:<28} {:>10} {:>10} {:>8}'.format('case', 'baseline', 'now', 'ratio'))
+    for name in sorted(set(results) & set(baseline)):
+        ratio = results[name]['seconds'] / baseline[name]['seconds']
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  slower'
+        print('{:<28} {:10.4f} {:10.4f} {:8.2f}{}'.format(name, baseline[name]['seconds'], results[name]['seconds'],
+                                                         ratio, flag))
+    print('{:<28} {:>10} {:>10} {:>8}'.format('case (MB)', 'baseline', 'now', 'ratio'))
+    for name in sorted(set(results) & set(baseline)):
+        for metric in MEMORY_METRICS:
+            # baselines from before the memory metrics, or from a platform without rss_peak_mb, are skipped
+            before, now = baseline[name].get(metric), results[name].get(metric)
+            if before is None or now is None:
+                continue
+            flag = ''
+            if now > before * (1 + memory_tolerance) + memory_slack:
+                regressions.append('{} ({})'.format(name, metric))
+                flag = '  more memory'
+            print('{:<28} {:10.1f} {:10.1f} {:8.2f}{}'.format('{} {}'.format(name, metric.split('_')[0]), before,
+                                                             now, now / before if before > 0 else float('inf'),
+                                                             flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', type=int, default=4000, help='number of source rows')
+    parser.add_argument('--d', type=int, default=64)
+    parser.add_argument('--classes', type=int, default=4)
+    parser.add_argument('--shift', type=float, default=0.5)
+    parser.add_argument('--decays', type=float, nargs='+', default=[1e-2, 1e-4])
+    parser.add_argument('--estimators', nargs='+', default=['mlp', 'ensemble', 'logistic', 'ulsif', 'kliep'])
+    parser.add_argument('--e2e-estimator', default='logistic', help='get_weight estimator of cross_validation_loss')
+    parser.add_argument('--images', type=int, default=64, help='number of synthetic source images')
+    parser.add_argument('--image-size', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed fractional slowdown')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, help='allowed fractional memory growth')
+    parser.add_argument('--memory-slack', type=float, default=1.0,
+                        help='MB of memory growth allowed on top of --memory-tolerance')
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance, args.memory_tolerance, args.memory_slack)
+        if regressions:
+            print('regressed against the baseline: ' + ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,19 +8,159 @@ from PIL import Image
 import torch.utils.data as data
 import os
 import os.path
+import mmap
+import functools
+import zlib
+from multiprocessing import Pool
+from dev_core import class_partition, stratified_split
 
 def make_dataset(image_list, labels):
     if labels:
       len_ = len(image_list)
       images = [(image_list[i].strip(), labels[i, :]) for i in range(len_)]
     else:
-      if len(image_list[0].split()) > 2:
-        images = [(val.split()[0], np.array([int(la) for la in val.split()[1:]])) for val in image_list]
+      fields = [val.split() for val in image_list]
+      if len(fields[0]) > 2:
+        images = [(field[0], np.array([int(la) for la in field[1:]])) for field in fields]
       else:
-        images = [(val.split()[0], int(val.split()[1])) for val in image_list]
+        images = [(field[0], int(field[1])) for field in fields]
     return images
 
 
+def _parse_image_list(data):
+    """Parse "path label [label ...]" lines from a bytes buffer with array operations only.
+    Returns (paths, offsets, labels) as ImageIndex stores them."""
+    buf = np.frombuffer(data, dtype=np.uint8)
+    is_token = (buf != 32) & (buf != 9) & (buf != 10) & (buf != 13)
+    before = np.concatenate(([False], is_token[:-1]))
+    after = np.concatenate((is_token[1:], [False]))
+    starts = np.flatnonzero(is_token & ~before)
+    ends = np.flatnonzero(is_token & ~after) + 1
+    # line of every token; the first token of a line is its path, the rest are its labels
+    line = np.searchsorted(np.flatnonzero(buf == 10), starts)
+    first = np.ones(len(starts), dtype=bool)
+    first[1:] = line[1:] != line[:-1]
+
+    path_starts, path_ends = starts[first], ends[first]
+    lengths = path_ends - path_starts
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    paths = buf[np.repeat(path_starts - offsets[:-1], lengths) + np.arange(offsets[-1])]
+
+    label_starts, label_ends = starts[~first], ends[~first]
+    counts = np.bincount(np.cumsum(first)[~first] - 1, minlength=len(lengths))
+    if len(counts) == 0 or counts.min() != counts.max() or counts[0] == 0:
+        raise ValueError('every line of an image list needs the same number (at least one) of labels')
+    width = label_ends - label_starts
+    labels = np.zeros(len(label_starts), dtype=np.int64)
+    for j in range(int(width.max())):
+        more = width > j
+        digit = buf[label_starts[more] + j].astype(np.int64) - 48
+        if digit.min() < 0 or digit.max() > 9:
+            raise ValueError('labels of an image list must be non-negative integers')
+        labels[more] = labels[more] * 10 + digit
+    labels = labels.astype(np.int32)
+    if counts[0] > 1:
+        labels = labels.reshape(len(lengths), counts[0])
+    return paths, offsets, labels
+
+
+class ImageIndex(object):
+    """Compact, array-backed replacement for the (path, label) list of make_dataset.
+    All paths live in one uint8 buffer with an offsets array and the labels in one int32 array,
+    so a DataLoader worker forked from the main process touches three objects instead of one
+    Python tuple per image, and building it from a list file takes a few vectorised passes.
+    Args:
+        paths (ndarray): uint8 buffer of the utf-8 paths back to back.
+        offsets (ndarray): [N + 1] int64, path i is paths[offsets[i]:offsets[i + 1]].
+        labels (ndarray): [N] int32 labels, or [N, K] for multi-label lists.
+    """
+
+    def __init__(self, paths, offsets, labels):
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+
+    @classmethod
+    def from_lines(cls, image_list):
+        return cls(*_parse_image_list('\n'.join(image_list).encode('utf-8')))
+
+    @classmethod
+    def from_file(cls, list_path, sidecar=True):
+        """Read a list file in bulk. With sidecar, the parsed index is saved next to the list as
+        list_path + '.idx.npz' and reloaded from there while it is newer than the list."""
+        index_path = list_path + '.idx.npz'
+        if sidecar and os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(list_path):
+            return cls.load(index_path)
+        with open(list_path, 'rb') as f:
+            index = cls(*_parse_image_list(f.read()))
+        if sidecar:
+            index.save(index_path)
+        return index
+
+    def save(self, path):
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, paths=self.paths, offsets=self.offsets, labels=self.labels)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['paths'], data['offsets'], data['labels'])
+
+    def path(self, index):
+        return self.paths[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        label = self.labels[index]
+        return self.path(index), label if self.labels.ndim > 1 else int(label)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+def list_labels(image_list):
+    """Labels of "path label" lines (or of an ImageIndex) as an [N] int64 array."""
+    if isinstance(image_list, ImageIndex):
+        return image_list.labels.astype(np.int64)
+    return np.asarray([int(line.split()[1]) for line in image_list], dtype=np.int64)
+
+
+def split_set(source_path, class_num, split = 0.4, seed=None, index_path=None):
+    """
+    Split the source list into a list of list of source and a list of list of validation
+    :param source_path:
+    :param class_num:
+    :param split: fraction of every class that goes to validation
+    :param seed: None keeps the last lines of every class for validation, otherwise a seeded random subset
+    :param index_path: .npz file persisting the train and validation row indices; reused when it was saved for
+    the same list, class_num, split and seed, rebuilt otherwise
+    :return:
+    """
+    source_list = open(source_path).readlines()
+    labels = list_labels(source_list)
+    # what the saved rows depend on; a seed of None is stored as -1, which RandomState does not accept
+    key = {'lines': len(source_list), 'labels_crc': zlib.crc32(labels.tobytes()), 'class_num': class_num,
+           'split': split, 'seed': -1 if seed is None else seed}
+    train_rows = val_rows = None
+    if index_path is not None and os.path.exists(index_path):
+        with np.load(index_path) as rows:
+            if all(name in rows and rows[name] == value for name, value in key.items()):
+                train_rows, val_rows = rows['train'], rows['val']
+    if train_rows is None:
+        train_rows, val_rows = stratified_split(labels, class_num, split, seed)
+        if index_path is not None:
+            np.savez(index_path, train=train_rows, val=val_rows, **key)
+    src_list = []
+    val_list = []
+    for rows, cls_lists in ((train_rows, src_list), (val_rows, val_list)):
+        # rows are grouped by class, cut them at the class boundaries
+        bounds = np.cumsum(np.bincount(labels[rows], minlength=class_num))[:-1]
+        for cls_rows in np.split(rows, bounds):
+            cls_lists.append([source_list[i] for i in cls_rows])
+    return src_list, val_list
+
+
 def pil_loader(path):
     # open path as file to avoid ResourceWarning (https://github.com/python-pillow/Pillow/issues/835)
     with open(path, 'rb') as f:
@@ -28,6 +168,16 @@ def pil_loader(path):
             return img.convert('RGB')
 
 
+def pil_draft_loader(path, size=256):
+    """Decode a JPEG at the smallest DCT scale (1/2, 1/4 or 1/8) that still covers size x size,
+    instead of at full resolution; other formats decode as pil_loader does."""
+    with open(path, 'rb') as f:
+        with Image.open(f) as img:
+            if img.format == 'JPEG':
+                img.draft('RGB', (size, size))
+            return img.convert('RGB')
+
+
 def accimage_loader(path):
     import accimage
     try:
@@ -38,13 +188,135 @@ def accimage_loader(path):
 
 
 def default_loader(path):
-    #from torchvision import get_image_backend
-    #if get_image_backend() == 'accimage':
-    #    return accimage_loader(path)
-    #else:
+    from torchvision import get_image_backend
+    if get_image_backend() == 'accimage':
+        return accimage_loader(path)
+    else:
         return pil_loader(path)
 
 
+LOADERS = {
+    'default': default_loader,
+    'pil': pil_loader,
+    'pil_draft': pil_draft_loader,
+    'accimage': accimage_loader,
+}
+
+
+class FallbackLoader(object):
+    """Tries a chain of loaders in order. A loader whose backend is not installed (ImportError)
+    is dropped from the chain for good; one that cannot decode an image (IOError/OSError) is
+    skipped for that image only.
+    Args:
+        loaders (list): Loader callables, in order of preference.
+    """
+
+    def __init__(self, loaders):
+        self.loaders = list(loaders)
+
+    def __call__(self, path):
+        error = None
+        for loader in list(self.loaders):
+            try:
+                return loader(path)
+            except ImportError as e:
+                self.loaders.remove(loader)
+                error = e
+            except (IOError, OSError) as e:
+                error = e
+        raise RuntimeError('no image loader could load {}: {}'.format(path, error))
+
+
+def get_loader(loader, size=256):
+    """Resolve a loader given by name (a key of LOADERS), callable, or list of them forming a
+    fallback chain, e.g. ['accimage', 'pil_draft', 'pil'].
+    Args:
+        size (int): Target size for reduced-size decoding ('pil_draft').
+    """
+    if isinstance(loader, (list, tuple)):
+        return FallbackLoader([get_loader(l, size) for l in loader])
+    if callable(loader):
+        return loader
+    if loader == 'pil_draft':
+        return functools.partial(pil_draft_loader, size=size)
+    return LOADERS[loader]
+
+
+def _decode_resized(args):
+    path, loader, size = args
+    img = loader(path).resize(size)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def build_image_shard(image_list, shard_path, resize_size=256, loader=default_loader, num_workers=0):
+    """Decode and resize every image of image_list once, into a shard that ImageShard reads back.
+    Writes shard_path.bin (the uint8 HWC pixels of every image, back to back), shard_path.idx.npy
+    ([N, 3] int64 rows of byte offset, height, width) and shard_path.txt (the image paths, one per row).
+    Args:
+        image_list (list): "path label" lines.
+        resize_size (int or tuple): Size the images are resized to, as ResizeImage does.
+        loader (callable): Function decoding an image path to a PIL image.
+        num_workers (int): Processes decoding in parallel, 0 to decode in this process.
+    """
+    size = (resize_size, resize_size) if isinstance(resize_size, int) else tuple(resize_size)
+    paths = [line.split()[0] for line in image_list]
+    jobs = [(path, loader, size) for path in paths]
+    pool = Pool(num_workers) if num_workers > 0 else None
+    arrays = pool.imap(_decode_resized, jobs, chunksize=16) if pool is not None else map(_decode_resized, jobs)
+    index = np.empty((len(paths), 3), dtype=np.int64)
+    offset = 0
+    try:
+        with open(shard_path + '.bin.tmp', 'wb') as f:
+            for i, array in enumerate(arrays):
+                index[i] = (offset, array.shape[0], array.shape[1])
+                f.write(array.tobytes())
+                offset += array.nbytes
+    finally:
+        if pool is not None:
+            pool.close()
+    os.replace(shard_path + '.bin.tmp', shard_path + '.bin')
+    np.save(shard_path + '.idx.npy', index)
+    with open(shard_path + '.txt', 'w') as f:
+        f.write('\n'.join(paths) + '\n')
+
+
+class ImageShard(object):
+    """Reads the images of a shard written by build_image_shard without decoding them.
+    The pixel file is mapped on first access (so every DataLoader worker maps it on its own) and
+    images are returned as views into the mapping, so a read is a page-cache read and no copy.
+    Args:
+        shard_path (string): Path given to build_image_shard.
+        as_tensor (bool): Return uint8 HWC tensors instead of PIL images.
+    """
+
+    def __init__(self, shard_path, as_tensor=False):
+        self.shard_path = shard_path
+        self.as_tensor = as_tensor
+        self.index = np.load(shard_path + '.idx.npy')
+        with open(shard_path + '.txt') as f:
+            self.rows = dict((path, row) for row, path in enumerate(f.read().splitlines()))
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def array(self, path):
+        if self._data is None:
+            with open(self.shard_path + '.bin', 'rb') as f:
+                # copy-on-write mapping, so the views are writable as torch.from_numpy expects
+                self._data = np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY), dtype=np.uint8)
+        offset, height, width = self.index[self.rows[path]]
+        return self._data[offset:offset + height * width * 3].reshape(height, width, 3)
+
+    def __call__(self, path):
+        array = self.array(path)
+        if self.as_tensor:
+            return torch.from_numpy(array)
+        return Image.frombuffer('RGB', (array.shape[1], array.shape[0]), array, 'raw', 'RGB', 0, 1)
+
+
 class ImageList(object):
     """A generic data loader where the images are arranged in this way: ::
         root/dog/xxx.png
@@ -54,12 +326,15 @@ class ImageList(object):
         root/cat/nsdf3.png
         root/cat/asd932_.png
     Args:
-        root (string): Root directory path.
+        image_list (list or ImageIndex): "path label" lines, or an already parsed ImageIndex.
         transform (callable, optional): A function/transform that  takes in an PIL image
             and returns a transformed version. E.g, ``transforms.RandomCrop``
         target_transform (callable, optional): A function/transform that takes in the
             target and transforms it.
-        loader (callable, optional): A function to load an image given its path.
+        loader (callable, string or list, optional): A function to load an image given its path,
+            or a name in LOADERS / a fallback chain of them, see get_loader.
+        shard (string, optional): Path of a shard written by build_image_shard; the images
+            are read from it already decoded and resized instead of through loader.
      Attributes:
         classes (list): List of the class names.
         class_to_idx (dict): Dict with items (class_name, class_index).
@@ -67,8 +342,8 @@ class ImageList(object):
     """
 
     def __init__(self, image_list, labels=None, transform=None, target_transform=None,
-                 loader=default_loader):
-        imgs = make_dataset(image_list, labels)
+                 loader=default_loader, shard=None):
+        imgs = image_list if isinstance(image_list, ImageIndex) else make_dataset(image_list, labels)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
@@ -76,7 +351,7 @@ class ImageList(object):
         self.imgs = imgs
         self.transform = transform
         self.target_transform = target_transform
-        self.loader = loader
+        self.loader = ImageShard(shard) if shard is not None else get_loader(loader)
 
     def __getitem__(self, index):
         """
@@ -106,7 +381,7 @@ class ImageValueList(object):
         root/cat/nsdf3.png
         root/cat/asd932_.png
     Args:
-        root (string): Root directory path.
+        image_list (list or ImageIndex): "path label" lines, or an already parsed ImageIndex.
         transform (callable, optional): A function/transform that  takes in an PIL image
             and returns a transformed version. E.g, ``transforms.RandomCrop``
         target_transform (callable, optional): A function/transform that takes in the
@@ -120,18 +395,21 @@ class ImageValueList(object):
 
     def __init__(self, image_list, labels=None, transform=None, target_transform=None,
                  loader=default_loader):
-        imgs = make_dataset(image_list, labels)
+        imgs = image_list if isinstance(image_list, ImageIndex) else make_dataset(image_list, labels)
         if len(imgs) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
                                "Supported image extensions are: " + ",".join(IMG_EXTENSIONS)))
 
         self.imgs = imgs
-        self.values = [1.0] * len(imgs)
+        self.values = np.ones(len(imgs), dtype=np.float32)
         self.transform = transform
         self.target_transform = target_transform
-        self.loader = loader
+        self.loader = get_loader(loader)
 
     def set_values(self, values):
+        values = np.asarray(values, dtype=np.float32).reshape(-1)
+        if len(values) != len(self.imgs):
+            raise ValueError('expected {} values, got {}'.format(len(self.imgs), len(values)))
         self.values = values
 
     def __getitem__(self, index):
@@ -153,3 +431,126 @@ class ImageValueList(object):
     def __len__(self):
         return len(self.imgs)
 
+
+def build_alias_table(weights):
+    """
+    Walker alias table of a weight vector, built without a per-item loop
+    This is Vose's construction with the larges used in index order: small i is paired with the large that is
+    current once the deficits 1 - q of the smalls before it are paid, and a large whose remaining mass drops
+    below one becomes a bucket aliased to the next large. Every large that closes takes one unit of the
+    supply, so the large of every small and the closing point of every large come from two searchsorted calls.
+    :param weights: shape [n], non-negative with a positive sum
+    :return: (prob, alias), shape [n] float32 and int64; draw k uniformly, keep it with probability prob[k],
+    otherwise take alias[k]
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    q = weights * (n / weights.sum())
+    small = np.flatnonzero(q < 1)
+    large = np.flatnonzero(q >= 1)
+    prob = np.ones(n, dtype=np.float32)
+    alias = np.arange(n, dtype=np.int64)
+    if len(small) == 0:
+        return prob, alias
+    # D[k]: deficits paid before small k; supply_end[j]: mass of the larges up to and including j
+    D = np.concatenate(([0.0], np.cumsum(1 - q[small])))
+    supply_end = np.cumsum(q[large])
+    # large j closes once the deficits paid exceed B[j] = supply_end[j] - 1 - j, non-decreasing since q >= 1
+    B = supply_end - 1 - np.arange(len(large))
+    current = np.minimum(np.searchsorted(B, D[:-1], side='left'), len(large) - 1)
+    prob[small] = q[small]
+    alias[small] = large[current]
+    closed_at = D[np.minimum(np.searchsorted(D, B, side='right'), len(D) - 1)]
+    remaining = np.clip(supply_end - (closed_at + np.arange(len(large))), 0, 1)
+    prob[large[:-1]] = remaining[:-1]
+    alias[large[:-1]] = large[1:]
+    return prob, alias
+
+
+class AliasSampler(data.Sampler):
+    """Draws indices with replacement in proportion to a weight vector, e.g. ImageValueList.values.
+
+    The items are split into blocks of block_size with an alias table each, and a second alias
+    table picks the block by its total weight, so a draw is two O(1) lookups and update only
+    rebuilds the blocks it touches plus the small table over blocks. The draws of an epoch depend
+    only on seed and the epoch set with set_epoch, so every replica (and a resumed run) sees the same
+    sequence; with num_replicas > 1 each rank takes every num_replicas-th draw of it.
+    Args:
+        data_source (ImageValueList or array): Dataset whose values are the weights, or the weights.
+        num_samples (int): Draws per epoch over all replicas, len(data_source) if None.
+        block_size (int): Number of items per alias table.
+        seed (int): Seed of the draws.
+        num_replicas (int): Number of distributed ranks sharing the draws.
+        rank (int): Rank of this sampler.
+    """
+
+    def __init__(self, data_source, num_samples=None, block_size=65536, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        values = data_source.values if hasattr(data_source, 'values') else data_source
+        self.weights = np.array(values, dtype=np.float32).reshape(-1)
+        if (self.weights < 0).any():
+            raise ValueError('weights must be non-negative')
+        self.num_samples = len(self.weights) if num_samples is None else num_samples
+        self.block_size = block_size
+        self.seed = seed
+        self.epoch = 0
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.starts = np.arange(0, len(self.weights), block_size)
+        self.sizes = np.minimum(block_size, len(self.weights) - self.starts)
+        self.prob = np.empty(len(self.weights), dtype=np.float32)
+        self.alias = np.empty(len(self.weights), dtype=np.int64)
+        self.block_weight = np.zeros(len(self.starts))
+        self._build_blocks(range(len(self.starts)))
+
+    def _build_blocks(self, blocks):
+        for block in blocks:
+            start, end = self.starts[block], self.starts[block] + self.sizes[block]
+            weights = self.weights[start:end]
+            self.block_weight[block] = weights.sum(dtype=np.float64)
+            if self.block_weight[block] > 0:
+                prob, alias = build_alias_table(weights)
+                self.prob[start:end] = prob
+                self.alias[start:end] = alias + start
+        if self.block_weight.sum() <= 0:
+            raise ValueError('weights must have a positive sum')
+        self.block_prob, self.block_alias = build_alias_table(self.block_weight)
+
+    def update(self, indices, values):
+        """
+        Change the weights of some items in place, rebuilding only the blocks they fall in
+        :param indices: item indices
+        :param values: their new weights
+        :return:
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        values = np.asarray(values, dtype=np.float32).reshape(-1)
+        if (values < 0).any():
+            raise ValueError('weights must be non-negative')
+        self.weights[indices] = values
+        if hasattr(self.data_source, 'values'):
+            self.data_source.values[indices] = values
+        self._build_blocks(np.unique(indices // self.block_size))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def draw(self, n, rng):
+        """Return n indices drawn in proportion to the weights."""
+        block = rng.integers(0, len(self.block_prob), size=n)
+        block = np.where(rng.random(n, dtype=np.float32) < self.block_prob[block], block, self.block_alias[block])
+        item = self.starts[block] + (rng.random(n) * self.sizes[block]).astype(np.int64)
+        return np.where(rng.random(n, dtype=np.float32) < self.prob[item], item, self.alias[item])
+
+    def __iter__(self, chunk_size=65536):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        for start in range(0, self.num_samples, chunk_size):
+            indices = self.draw(min(chunk_size, self.num_samples - start), rng)
+            # the draws of this rank, counted over the whole epoch
+            offset = (self.rank - start) % self.num_replicas
+            for index in indices[offset::self.num_replicas]:
+                yield int(index)
+
+    def __len__(self):
+        return len(range(self.rank, self.num_samples, self.num_replicas))
+
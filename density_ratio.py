@@ -0,0 +1,173 @@
+import numpy as np
+from scipy.optimize import minimize
+from sklearn.decomposition import PCA
+from sklearn.linear_model import LogisticRegression
+from sklearn.random_projection import GaussianRandomProjection
+
+# Every estimator shares the signature of dev.fit_domain_classifiers:
+#     fit(decays, feature_for_train, label_for_train, feature_for_test, label_for_test, **options)
+# with label 1 for source and 0 for target rows, and returns one (score, model) pair per decay,
+# a higher held-out score being better. A model either has predict_proba (a domain classifier,
+# turned into weights by get_weight) or density_ratio, which returns p_target(x) / p_source(x) directly.
+
+
+def fit_logistic(decays, feature_for_train, label_for_train, feature_for_test, label_for_test, max_iter=200):
+    """
+    L-BFGS logistic regression domain classifiers, scored by held-out accuracy
+    decay plays the part of MLPClassifier's alpha: the mean log loss is penalised by 0.5 * decay * ||w||^2 / N,
+    which is C = 1 / decay in sklearn's parametrisation.
+    :return: list of (val acc, LogisticRegression), one per decay
+    """
+    results = []
+    for decay in decays:
+        domain_classifier = LogisticRegression(C=1.0 / decay, solver='lbfgs', max_iter=max_iter)
+        domain_classifier.fit(feature_for_train, label_for_train)
+        output = domain_classifier.predict(feature_for_test)
+        acc = np.mean((label_for_test == output).astype(np.float32))
+        results.append((acc, domain_classifier))
+    return results
+
+
+class RandomFourierFeatures(object):
+    """Random Fourier features of a Gaussian kernel, sqrt(2 / D) * cos(x W + b), plus a constant feature.
+    Args:
+        n_components (int): Number of random features D.
+        bandwidth (float): Kernel width, the median pairwise distance of the data passed to fit if None.
+        random_state (int): Seed of W and b.
+    """
+
+    def __init__(self, n_components=512, bandwidth=None, random_state=None):
+        self.n_components = n_components
+        self.bandwidth = bandwidth
+        self.random_state = random_state
+
+    def fit(self, feature):
+        rng = np.random.RandomState(self.random_state)
+        feature = np.asarray(feature, dtype=np.float64)
+        bandwidth = self.bandwidth
+        if bandwidth is None:
+            sample = feature[rng.choice(len(feature), size=min(len(feature), 1000), replace=False)]
+            sq_norm = (sample ** 2).sum(axis=1)
+            distance = np.sqrt(np.maximum(sq_norm[:, None] + sq_norm[None, :] - 2 * sample.dot(sample.T), 0))
+            bandwidth = np.median(distance[np.triu_indices(len(sample), k=1)]) or 1.0
+        self.weight_ = rng.normal(scale=1.0 / bandwidth, size=(feature.shape[1], self.n_components))
+        self.bias_ = rng.uniform(0, 2 * np.pi, size=self.n_components)
+        return self
+
+    def transform(self, feature):
+        projection = np.asarray(feature, dtype=np.float64).dot(self.weight_) + self.bias_
+        basis = np.sqrt(2.0 / self.n_components) * np.cos(projection)
+        return np.concatenate((basis, np.ones((len(basis), 1))), axis=1)
+
+
+class LinearDensityRatio(object):
+    """r(x) = max(phi(x) . theta, 0), the uLSIF model."""
+
+    def __init__(self, features, theta):
+        self.features = features
+        self.theta = theta
+
+    def density_ratio(self, feature):
+        return np.maximum(self.features.transform(feature).dot(self.theta), 0)
+
+
+class LogLinearDensityRatio(object):
+    """r(x) = exp(phi(x) . theta) / Z, normalised to a mean of one over the source training rows, the
+    log-linear KLIEP model."""
+
+    def __init__(self, features, theta, log_normaliser):
+        self.features = features
+        self.theta = theta
+        self.log_normaliser = log_normaliser
+
+    def density_ratio(self, feature):
+        return np.exp(self.features.transform(feature).dot(self.theta) - self.log_normaliser)
+
+
+def fit_ulsif(decays, feature_for_train, label_for_train, feature_for_test, label_for_test, n_components=512,
+              bandwidth=None, random_state=None):
+    """
+    Closed-form uLSIF density ratio estimates on random Fourier features, one per ridge penalty decay
+    theta = (H + decay I)^-1 h, with H the source second moment of the features and h their target mean.
+    Scored by the held-out uLSIF criterion, -(0.5 * mean_source r^2 - mean_target r).
+    :return: list of (score, LinearDensityRatio), one per decay
+    """
+    label_for_train = np.asarray(label_for_train)
+    label_for_test = np.asarray(label_for_test)
+    features = RandomFourierFeatures(n_components, bandwidth, random_state).fit(feature_for_train)
+    phi = features.transform(feature_for_train)
+    phi_source = phi[label_for_train == 1]
+    H = phi_source.T.dot(phi_source) / len(phi_source)
+    h = phi[label_for_train == 0].mean(axis=0)
+    phi_test = features.transform(feature_for_test)
+    results = []
+    for decay in decays:
+        theta = np.linalg.solve(H + decay * np.eye(len(H)), h)
+        ratio = np.maximum(phi_test.dot(theta), 0)
+        score = -(0.5 * np.mean(ratio[label_for_test == 1] ** 2) - np.mean(ratio[label_for_test == 0]))
+        results.append((score, LinearDensityRatio(features, theta)))
+    return results
+
+
+def fit_kliep(decays, feature_for_train, label_for_train, feature_for_test, label_for_test, n_components=512,
+              bandwidth=None, random_state=None, max_iter=200):
+    """
+    Log-linear KLIEP density ratio estimates on random Fourier features, one per L2 penalty decay
+    Maximises mean_target log r - 0.5 * decay * ||theta||^2 with L-BFGS, warm starting from the previous decay.
+    Scored by the held-out KLIEP objective, the mean of log r over the target rows with r normalised over the
+    held-out source rows.
+    :return: list of (score, LogLinearDensityRatio), one per decay
+    """
+    label_for_train = np.asarray(label_for_train)
+    label_for_test = np.asarray(label_for_test)
+    features = RandomFourierFeatures(n_components, bandwidth, random_state).fit(feature_for_train)
+    phi = features.transform(feature_for_train)
+    phi_source = phi[label_for_train == 1]
+    target_mean = phi[label_for_train == 0].mean(axis=0)
+
+    def log_normaliser(theta):
+        logit = phi_source.dot(theta)
+        top = logit.max()
+        prob = np.exp(logit - top)
+        return top + np.log(prob.mean()), prob / prob.sum()
+
+    results = []
+    theta = np.zeros(phi.shape[1])
+    phi_test = features.transform(feature_for_test)
+    for decay in decays:
+        def objective(theta):
+            log_z, prob = log_normaliser(theta)
+            value = theta.dot(target_mean) - log_z - 0.5 * decay * theta.dot(theta)
+            grad = target_mean - prob.dot(phi_source) - decay * theta
+            return -value, -grad
+        theta = minimize(objective, theta, jac=True, method='L-BFGS-B', options={'maxiter': max_iter}).x
+        log_z = log_normaliser(theta)[0]
+        test_logit = phi_test[label_for_test == 1].dot(theta)
+        test_log_z = test_logit.max() + np.log(np.mean(np.exp(test_logit - test_logit.max())))
+        score = np.mean(phi_test[label_for_test == 0].dot(theta)) - test_log_z
+        results.append((score, LogLinearDensityRatio(features, theta, log_z)))
+    return results
+
+
+ESTIMATORS = {
+    'logistic': fit_logistic,
+    'ulsif': fit_ulsif,
+    'kliep': fit_kliep,
+}
+
+
+def make_reducer(reduce, n_components=256, random_state=None):
+    """
+    Dimension reduction fitted on the training features before any estimator
+    :param reduce: 'pca', 'random' (Gaussian random projection) or None
+    :param n_components:
+    :param random_state:
+    :return: an unfitted sklearn transformer, or None
+    """
+    if reduce is None:
+        return None
+    if reduce == 'pca':
+        return PCA(n_components=n_components, svd_solver='randomized', random_state=random_state)
+    if reduce == 'random':
+        return GaussianRandomProjection(n_components=n_components, random_state=random_state)
+    raise ValueError('unknown reduction: {}'.format(reduce))
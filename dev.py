@@ -1,76 +1,394 @@
-import random
-import torch
+import copy
+import hashlib
+import importlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from queue import Queue
 import math
 import numpy as np
-from sklearn.neural_network import MLPClassifier
-from sklearn.model_selection import train_test_split
-import torch.utils.data as util_data
-from data_list import ImageList
-import pre_process as prep
-import torch.nn as nn
-
-def get_dev_risk(weight, error):
-    """
-    :param weight: shape [N, 1], the importance weight for N source samples in the validation set
-    :param error: shape [N, 1], the error value for each source sample in the validation set
-    (typically 0 for correct classification and 1 for wrong classification)
-    """
-    N, d = weight.shape
-    _N, _d = error.shape
-    assert N == _N and d == _d, 'dimension mismatch!'
-    weighted_error = weight * error # weight correspond to Ntr/Nts, error correspond to validation error
-    cov = np.cov(np.concatenate((weighted_error, weight), axis=1),rowvar=False)[0][1]
-    var_w = np.var(weight, ddof=1)
-    eta = - cov / var_w
-    return np.mean(weighted_error) + eta * np.mean(weight) - eta
-
-def get_weight(source_feature, target_feature, validation_feature): # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
+from dev_core import (DECAYS, DevRiskAccumulator, bootstrap_dev_risk, class_index, class_partition,
+                      dev_risk_interval, get_dev_risk, get_dev_risks, odds_to_weight, random_select_index,
+                      stratified_split)
+from feature_cache import FeatureCache, network_hash
+from metrics import Tracer, get_tracer, use_tracer
+
+class _LazyModule(object):
+    """A module imported on first attribute access, so importing dev does not load torch or torchvision."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+torch = _LazyModule('torch')
+util_data = _LazyModule('torch.utils.data')
+nn = _LazyModule('torch.nn')
+prep = _LazyModule('pre_process')
+
+# start method of the pools that may start workers while other threads run: a forked child can inherit a lock
+# (e.g. Tracer._lock) held by another thread at that moment and block on it forever
+_THREAD_SAFE_START = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# names dev used to import from the heavy modules, still importable from dev and loaded on first access
+_LAZY_NAMES = {
+    'ImageList': 'data_list', 'list_labels': 'data_list', 'split_set': 'data_list',
+    'MLPClassifier': 'sklearn.neural_network',
+    'SEARCHES': 'domain_search', 'search_space': 'domain_search',
+    'fit_ensemble_domain_classifiers': 'domain_ensemble', 'score_ensemble': 'domain_ensemble',
+    'train_ensemble': 'domain_ensemble',
+    'ESTIMATORS': 'density_ratio', 'make_reducer': 'density_ratio',
+}
+
+def __getattr__(name):
+    if name in _LAZY_NAMES:
+        return getattr(importlib.import_module(_LAZY_NAMES[name]), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+def fit_domain_classifiers(decays, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                           hidden_layer_sizes, early_stopping=False, warm_start=False):
+    """
+    Fit one domain classifier per decay and score it on the held-out split
+    :param decays: the L2 penalties to try, neighbouring values warm start each other if warm_start
+    :param feature_for_train:
+    :param label_for_train:
+    :param feature_for_test:
+    :param label_for_test:
+    :param hidden_layer_sizes:
+    :param early_stopping: stop each fit on an internal 10% validation split
+    :param warm_start: start each fit from the weights of the previous decay
+    :return: list of (val acc, domain classifier), one per decay
+    """
+    from sklearn.neural_network import MLPClassifier
+    results = []
+    domain_classifier = None
+    for decay in decays:
+        if warm_start and domain_classifier is not None:
+            domain_classifier = copy.deepcopy(domain_classifier)
+            domain_classifier.set_params(alpha=decay, warm_start=True)
+        else:
+            domain_classifier = MLPClassifier(hidden_layer_sizes=hidden_layer_sizes, activation='relu', alpha=decay,
+                                              early_stopping=early_stopping)
+        with get_tracer().span('fit_decay', decay=decay):
+            domain_classifier.fit(feature_for_train, label_for_train)
+        output = domain_classifier.predict(feature_for_test)
+        acc = np.mean((label_for_test == output).astype(np.float32))
+        results.append((acc, domain_classifier))
+    return results
+
+_worker_split = None
+
+def _init_decay_worker(split, n_threads):
+    # runs once in every worker of the decay pool: keeps the split and shares the cores between the workers
+    global _worker_split
+    from threadpoolctl import threadpool_limits
+    _worker_split = split
+    threadpool_limits(n_threads)
+
+def _fit_decay_chunk(decays, hidden_layer_sizes, early_stopping, warm_start):
+    return fit_domain_classifiers(decays, *_worker_split, hidden_layer_sizes=hidden_layer_sizes,
+                                  early_stopping=early_stopping, warm_start=warm_start)
+
+class DomainSplit(object):
+    """A train/holdout split of the concatenated source and target rows, held as indices.
+
+    Row i of the split is source row source_rows[i] for i < n_source and target row
+    i - n_source after that; the label is 1 for source and 0 for target. Nothing is copied
+    until gather is called, so memmapped or very large feature matrices are only read a
+    chunk at a time, and gathered rows are always float32.
+    Args:
+        source_feature (ndarray): [N_s, d] source features, any array supporting fancy indexing.
+        target_feature (ndarray): [N_t, d] target features.
+        source_rows (ndarray): Rows of source_feature taking part, all of them if None.
+        train_size (float): Fraction of the rows in the training split.
+        random_state (int): Seed of the split.
+    """
+
+    def __init__(self, source_feature, target_feature, source_rows=None, train_size=0.8, random_state=None):
+        self.source_feature = source_feature
+        self.target_feature = target_feature
+        self.source_rows = np.arange(len(source_feature)) if source_rows is None else np.asarray(source_rows)
+        self.n_source = len(self.source_rows)
+        self.n_target = len(target_feature)
+        self.d = source_feature.shape[1]
+        n = self.n_source + self.n_target
+        # same sizes as train_test_split(train_size=train_size)
+        n_test = n - int(math.floor(train_size * n))
+        rng = np.random.RandomState(random_state) if random_state is not None else np.random
+        order = rng.permutation(n)
+        self.train = order[n_test:]
+        self.test = order[:n_test]
+
+    def labels(self, rows):
+        return (rows < self.n_source).astype(np.int32)
+
+    def nbytes(self, rows):
+        return len(rows) * self.d * 4
+
+    def gather(self, rows):
+        """
+        :param rows: split row indices
+        :return: (feature, label), feature shape [len(rows), d] float32 in the order of rows
+        """
+        rows = np.asarray(rows)
+        label = self.labels(rows)
+        feature = np.empty((len(rows), self.d), dtype=np.float32)
+        source = label == 1
+        if source.any():
+            src_rows = self.source_rows[rows[source]]
+            # sorted reads are sequential on memmaps
+            order = np.argsort(src_rows, kind='stable')
+            gathered = np.empty((len(src_rows), self.d), dtype=np.float32)
+            gathered[order] = self.source_feature[src_rows[order]]
+            feature[source] = gathered
+        if not source.all():
+            feature[~source] = self.target_feature[rows[~source] - self.n_source]
+        return feature, label
+
+    def batches(self, rows, batch_size):
+        for start in range(0, len(rows), batch_size):
+            yield self.gather(rows[start:start + batch_size])
+
+
+def fit_domain_classifiers_partial(decays, split, hidden_layer_sizes, chunk_rows, max_iter=200, tol=1e-4,
+                                   n_iter_no_change=10, random_state=None):
+    """
+    fit_domain_classifiers on a DomainSplit that does not fit in memory
+    Every epoch streams the shuffled training rows through MLPClassifier.partial_fit chunk_rows at a time,
+    stopping like MLPClassifier.fit once the epoch loss has not improved by tol for n_iter_no_change epochs.
+    :param decays: the L2 penalties to try
+    :param split: DomainSplit
+    :param hidden_layer_sizes:
+    :param chunk_rows: number of rows gathered at once
+    :param max_iter: maximum number of epochs
+    :param tol:
+    :param n_iter_no_change:
+    :param random_state: seed of the chunk order
+    :return: list of (val acc, domain classifier), one per decay
+    """
+    from sklearn.neural_network import MLPClassifier
+    rng = np.random.RandomState(random_state) if random_state is not None else np.random
+    results = []
+    for decay in decays:
+        domain_classifier = MLPClassifier(hidden_layer_sizes=hidden_layer_sizes, activation='relu', alpha=decay)
+        best_loss = np.inf
+        no_change = 0
+        with get_tracer().span('fit_decay', decay=decay):
+            for _ in range(max_iter):
+                epoch_loss = 0.0
+                # chunks of a fresh permutation mix both domains and come in a random order; the rows are sorted
+                # inside a chunk only, so its memmap reads are sequential, and shuffled again after the gather
+                rows = rng.permutation(split.train)
+                for start in range(0, len(rows), chunk_rows):
+                    feature, label = split.gather(np.sort(rows[start:start + chunk_rows]))
+                    order = rng.permutation(len(label))
+                    domain_classifier.partial_fit(feature[order], label[order], classes=[0, 1])
+                    epoch_loss += domain_classifier.loss_ * len(label)
+                epoch_loss /= len(split.train)
+                no_change = 0 if epoch_loss < best_loss - tol else no_change + 1
+                best_loss = min(best_loss, epoch_loss)
+                if no_change >= n_iter_no_change:
+                    break
+        correct = 0
+        for feature, label in split.batches(split.test, chunk_rows):
+            correct += np.sum(domain_classifier.predict(feature) == label)
+        results.append((np.float32(correct) / len(split.test), domain_classifier))
+    return results
+
+def fit_ensemble_from_split(decays, split, hidden_layer_sizes, chunk_rows, learning_rate=1e-3, batch_size=200,
+                            max_iter=200, tol=1e-4, n_iter_no_change=10, random_state=None):
     """
+    fit_ensemble_domain_classifiers on a DomainSplit that does not fit in memory, gathering every minibatch
+    :return: list of (val acc, EnsembleMember), one per decay
+    """
+    from domain_ensemble import score_ensemble, train_ensemble
+    rng = np.random.RandomState(random_state) if random_state is not None else np.random
+
+    def minibatches():
+        for rows in np.array_split(rng.permutation(split.train), max(1, len(split.train) // batch_size)):
+            feature, label = split.gather(rows)
+            yield torch.from_numpy(feature), torch.from_numpy(label.astype(np.float32))
+
+    model = train_ensemble(decays, split.d, hidden_layer_sizes, minibatches, len(split.train), learning_rate,
+                           max_iter, tol, n_iter_no_change, random_state)
+    return score_ensemble(model, split.batches(split.test, chunk_rows))
+
+
+class ImportanceWeight(object):
+    """The importance weight p_target(x) / p_source(x) of a fitted domain classifier or density ratio model.
+    Args:
+        model: the selected estimator, with predict_proba or density_ratio.
+        scale (float): N_s / N_t of the rows a domain classifier was trained on, turning its odds into a ratio.
+        reducer: fitted transformer applied to the features first, or None.
+        trace (list): Record of every fit of an adaptive search, None after a full sweep.
+    """
+
+    def __init__(self, model, scale=1.0, reducer=None, trace=None):
+        self.model = model
+        self.scale = scale
+        self.reducer = reducer
+        self.trace = trace
+
+    def __call__(self, feature):
+        """
+        :param feature: shape [N_v, d], features from validation set
+        :return: shape [N_v, 1]
+        """
+        with get_tracer().span('predict', rows=len(feature)):
+            if self.reducer is not None:
+                feature = self.reducer.transform(feature)
+            if hasattr(self.model, 'density_ratio'):
+                # direct density ratio estimators already return p_target / p_source
+                return self.model.density_ratio(feature).reshape(-1, 1)
+            domain_out = self.model.predict_proba(feature)
+        return odds_to_weight(domain_out, self.scale) #(Ntr/Nts)*(1-M(fv))/M(fv)
+        # correspond to (Ntr/Nts)*(1-M(fv))/M(fv), M(fv) just indicate whether 0 or 1, meaning from source or target
+
+def select_importance_weight(decays, results, N_s, N_t, reducer=None, trace=None):
+    """
+    Pick the domain classifier with the best held-out score
+    :param decays:
+    :param results: list of (val acc, domain classifier), one per decay
+    :param N_s: number of source rows the classifiers were trained on
+    :param N_t: number of target rows
+    :param reducer: fitted transformer the classifiers were trained behind, or None
+    :param trace: search trace kept on the ImportanceWeight
+    :return: ImportanceWeight
+    """
+    val_acc = [acc for acc, _ in results]
+    domain_classifiers = [domain_classifier for _, domain_classifier in results]
+    index = val_acc.index(max(val_acc))
+    tracer = get_tracer()
+    for i, (decay, acc) in enumerate(zip(decays, val_acc)):
+        tracer.event('domain_classifier', decay=decay, val_acc=acc, selected=i == index)
+    return ImportanceWeight(domain_classifiers[index], N_s * 1.0 / N_t, reducer, trace)
+
+def fit_importance_weight(source_feature, target_feature, decays=DECAYS, n_jobs=1, early_stopping=False,
+                          warm_start=False, estimator='mlp', estimator_kwargs=None, reduce=None, n_components=256,
+                          memory_budget=None, search=None, widths=None, learning_rates=None, search_kwargs=None):
+    """
+    Fit the domain classifiers of get_weight and keep the selected one, so the weights of validation
+    features can be computed later, possibly in other processes
     :param source_feature: shape [N_tr, d], features from training set
     :param target_feature: shape [N_te, d], features from test set
-    :param validation_feature: shape [N_v, d], features from validation set
-    :return:
+    :param decays: the L2 penalties of the domain classifiers to choose from
+    :param n_jobs: number of processes fitting the decays in parallel, -1 for all cores; each process gets an
+    equal share of the BLAS threads
+    :param early_stopping: stop each fit on an internal 10% validation split
+    :param warm_start: start each fit from the weights of the neighbouring larger decay; with n_jobs > 1
+    every process warm starts along its own contiguous run of decays
+    :param estimator: 'mlp' fits one sklearn MLPClassifier per decay, 'ensemble' trains all decays at once as
+    a batched torch ensemble on the same minibatches (n_jobs, early_stopping and warm_start do not apply);
+    'logistic', 'ulsif' and 'kliep' are the cheaper estimators of density_ratio.ESTIMATORS, and any callable
+    with the signature of fit_domain_classifiers' first five arguments can be passed
+    :param estimator_kwargs: extra keyword arguments for the estimator
+    :param reduce: 'pca' or 'random' to project the features to n_components dimensions before the estimator
+    :param n_components:
+    :param memory_budget: bytes the float32 training matrix may take; above it 'mlp' trains with partial_fit
+    and 'ensemble' on minibatches gathered straight from source_feature and target_feature, which may be memmaps.
+    None for no limit; reduce and search are not available above it
+    :param search: 'halving' or 'hyperband' to pick the 'mlp' domain classifier by an adaptive search over decays,
+    widths and learning_rates on growing subsets of the training split (see domain_search) instead of fitting
+    every decay in full; the record of every fit is kept as the trace of the result
+    :param widths: hidden layer widths to search, the feature dimension only if None
+    :param learning_rates: adam learning rates to search, 1e-3 only if None
+    :param search_kwargs: extra keyword arguments for the search, e.g. {'eta': 3}
+    :return: ImportanceWeight, called on the validation features to get their weights
     """
+    from density_ratio import ESTIMATORS, make_reducer
+    from domain_ensemble import fit_ensemble_domain_classifiers
+    from domain_search import SEARCHES, search_space
     N_s, d = source_feature.shape  
     N_t, _d = target_feature.shape
-    if float(N_s)/N_t > 2:
-        source_feature = random_select_src(source_feature, target_feature)
-    else:
-        source_feature = source_feature.copy()
+    tracer = get_tracer()
+    tracer.event('domain_sizes', num_source=N_s, num_target=N_t, ratio=float(N_s) / N_t) #check the ratio
 
-    print('num_source is {}, num_target is {}, ratio is {}\n'.format(N_s, N_t, float(N_s) / N_t)) #check the ratio
+    source_rows = None
+    if float(N_s)/N_t > 2:
+        source_rows = random_select_index(N_s, 2 * N_t)
+        # the classifier sees the subsampled prior, so the density ratio uses the subsampled count
+        N_s = len(source_rows)
 
-    target_feature = target_feature.copy()
-    all_feature = np.concatenate((source_feature, target_feature))
-    all_label = np.asarray([1] * N_s + [0] * N_t,dtype=np.int32) # 1->source 0->target
-    feature_for_train,feature_for_test, label_for_train,label_for_test = train_test_split(all_feature, all_label, train_size = 0.8)
+    # 1->source 0->target, the train, test split only holds row indices into source_feature and target_feature
+    split = DomainSplit(source_feature, target_feature, source_rows)
+    tracer.count('rows', len(split.train) + len(split.test))
+    estimator_kwargs = estimator_kwargs or {}
+    estimator_name = getattr(estimator, '__name__', estimator)
+    if memory_budget is not None and split.nbytes(split.train) > memory_budget:
+        if reduce is not None or search is not None:
+            raise ValueError('reduce and search need the training matrix in memory, raise memory_budget or leave '
+                             'them unset')
+        chunk_rows = max(200, int(memory_budget // (4 * d)))
+        with tracer.span('fit', estimator=estimator_name, rows=len(split.train), streamed=True):
+            if estimator == 'mlp':
+                results = fit_domain_classifiers_partial(decays, split, (d, d, 2), chunk_rows)
+            elif estimator == 'ensemble':
+                results = fit_ensemble_from_split(decays, split, (d, d, 2), chunk_rows, **estimator_kwargs)
+            else:
+                raise ValueError('estimator {} needs the training matrix in memory, raise memory_budget or use mlp '
+                                 'or ensemble'.format(estimator))
+        return select_importance_weight(decays, results, N_s, N_t)
 
-    # here is train, test split, concatenating the data from source and target
+    feature_for_train, label_for_train = split.gather(split.train)
+    feature_for_test, label_for_test = split.gather(split.test)
 
-    decays = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5]
-    val_acc = []
-    domain_classifiers = []
-    
-    for decay in decays:
-        domain_classifier = MLPClassifier(hidden_layer_sizes=(d, d, 2),activation='relu',alpha=decay)
-        domain_classifier.fit(feature_for_train, label_for_train)
-        output = domain_classifier.predict(feature_for_test)
-        acc = np.mean((label_for_test == output).astype(np.float32))
-        val_acc.append(acc)
-        domain_classifiers.append(domain_classifier)
-        print('decay is %s, val acc is %s'%(decay, acc))
-        
-    index = val_acc.index(max(val_acc))
-    
-    print('val acc is')
-    print(val_acc)
+    reducer = make_reducer(reduce, min(n_components, feature_for_train.shape[0]))
+    if reducer is not None and d > n_components:
+        feature_for_train = reducer.fit_transform(feature_for_train)
+        feature_for_test = reducer.transform(feature_for_test)
+        d = feature_for_train.shape[1]
+    else:
+        reducer = None
 
-    domain_classifier = domain_classifiers[index]
+    if search is not None:
+        if estimator != 'mlp':
+            raise ValueError('search only applies to the mlp estimator')
+        configs = search_space(decays, widths, learning_rates)
+        trace = []
+        with tracer.span('fit', estimator=estimator_name, search=search, rows=len(feature_for_train)):
+            results = SEARCHES[search](configs, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                                       trace=trace, **(search_kwargs or {}))
+        for record in trace:
+            tracer.event('search_fit', **record)
+        candidates = [{'alpha': clf.alpha, 'width': clf.hidden_layer_sizes[0], 'learning_rate': clf.learning_rate_init}
+                      for _, clf in results]
+        return select_importance_weight(candidates, results, N_s, N_t, reducer, trace)
 
-    domain_out = domain_classifier.predict_proba(validation_feature)
-    return domain_out[:,:1] / domain_out[:,1:] * N_s * 1.0 / N_t #(Ntr/Nts)*(1-M(fv))/M(fv)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    n_jobs = max(1, min(n_jobs, len(decays)))
+    with tracer.span('fit', estimator=estimator_name, rows=len(feature_for_train)):
+        if callable(estimator) or estimator in ESTIMATORS:
+            fit = estimator if callable(estimator) else ESTIMATORS[estimator]
+            results = fit(decays, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                          **estimator_kwargs)
+        elif estimator == 'ensemble':
+            results = fit_ensemble_domain_classifiers(decays, feature_for_train, label_for_train, feature_for_test,
+                                                      label_for_test, (d, d, 2), **estimator_kwargs)
+        elif estimator != 'mlp':
+            raise ValueError('unknown estimator: {}'.format(estimator))
+        elif n_jobs == 1:
+            results = fit_domain_classifiers(decays, feature_for_train, label_for_train, feature_for_test,
+                                             label_for_test, (d, d, 2), early_stopping, warm_start)
+        else:
+            # warm starting chains neighbouring decays, so each process gets a contiguous run of them
+            chunk = int(math.ceil(len(decays) / float(n_jobs))) if warm_start else 1
+            chunks = [decays[i:i + chunk] for i in range(0, len(decays), chunk)]
+            # the split goes to every worker once, rather than with every chunk
+            split = (feature_for_train, label_for_train, feature_for_test, label_for_test)
+            context = multiprocessing.get_context(_THREAD_SAFE_START) if threading.active_count() > 1 else None
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=context, initializer=_init_decay_worker,
+                                     initargs=(split, max(1, (os.cpu_count() or 1) // n_jobs))) as executor:
+                futures = [executor.submit(_fit_decay_chunk, decay_chunk, (d, d, 2), early_stopping, warm_start)
+                           for decay_chunk in chunks]
+                results = [result for future in futures for result in future.result()]
 
-    # correspond to (Ntr/Nts)*(1-M(fv))/M(fv), M(fv) just indicate whether 0 or 1, meaning from source or target
+    return select_importance_weight(decays, results, N_s, N_t, reducer)
 
 # added function
 
@@ -129,33 +447,111 @@ def get_weight(source_feature, target_feature, validation_feature): # 这三个f
 #         score += np.mean(weighted_error) + eta * np.mean(weight[i]) - eta
 #     return score
 
-def random_select_src(source_feature, target_feature):
+def get_weight(source_feature, target_feature, validation_feature, decays=DECAYS, n_jobs=1, early_stopping=False,
+               warm_start=False, estimator='mlp', estimator_kwargs=None, reduce=None, n_components=256,
+               memory_budget=None, search=None, widths=None, learning_rates=None, search_kwargs=None): # 这三个feature根据类别不同，是不一样的. source与target这里需注意一下数据量threshold 2倍的事儿
     """
-    Select at most 2*Ntr data from source feature randomly
+    Importance weights of the validation samples, fit_importance_weight(...)(validation_feature)
     :param source_feature: shape [N_tr, d], features from training set
     :param target_feature: shape [N_te, d], features from test set
-    :return:
+    :param validation_feature: shape [N_v, d], features from validation set
+    the other parameters are those of fit_importance_weight
+    :return: shape [N_v, 1]
     """
-    N_s, d = source_feature.shape
-    N_t, _d = target_feature.shape
-    items = [i for i in range(1, N_s)]
-    random_list = random.sample(items, 2 * N_t - 1)
-    new_source_feature = source_feature[0].reshape(1, d)
-    for i in range(2 * N_t):
-        new_source_feature = np.concatenate((new_source_feature, source_feature[random_list[i]].reshape(1, d)))
-    return new_source_feature
+    return fit_importance_weight(source_feature, target_feature, decays, n_jobs, early_stopping, warm_start, estimator,
+                                 estimator_kwargs, reduce, n_components, memory_budget, search, widths, learning_rates,
+                                 search_kwargs)(validation_feature)
+
+
+def random_select_src(source_feature, target_feature, labels=None, random_state=None):
+    """
+    Select 2*N_te rows from source feature randomly, in one gather
+    :param source_feature: shape [N_tr, d], features from training set (an array or a memmap)
+    :param target_feature: shape [N_te, d], features from test set
+    :param labels: shape [N_tr], optional class of every source row for class-stratified sampling
+    :param random_state: seed, the global numpy state if None
+    :return: shape [2*N_te, d]
+    """
+    N_s = source_feature.shape[0]
+    N_t = target_feature.shape[0]
+    return source_feature[random_select_index(N_s, 2 * N_t, labels, random_state)]
+
+def reservoir_select_src(source_batches, n, chunk_size=65536, random_state=None):
+    """
+    Select n source rows uniformly at random in one pass over a stream (reservoir sampling), so the
+    full source matrix never has to be in memory
+    :param source_batches: iterable of [B, d] feature batches, or an [N_tr, d] array / memmap read in chunks
+    :param n: number of rows to keep
+    :param chunk_size: rows per chunk when source_batches is an array
+    :param random_state: seed, the global numpy state if None
+    :return: shape [min(n, N_tr), d]
+    """
+    rng = np.random.RandomState(random_state) if random_state is not None else np.random
+    if isinstance(source_batches, np.ndarray):
+        array = source_batches
+        source_batches = (array[start:start + chunk_size] for start in range(0, len(array), chunk_size))
+    reservoir = None
+    seen = 0
+    for batch in source_batches:
+        batch = np.asarray(batch)
+        if reservoir is None:
+            reservoir = np.empty((n,) + batch.shape[1:], dtype=batch.dtype)
+        # fill the reservoir first
+        fill = min(max(n - seen, 0), len(batch))
+        reservoir[seen:seen + fill] = batch[:fill]
+        # row i (0-based, i >= n) replaces a random slot with probability n / (i + 1); numpy assigns
+        # in order, so later rows of the batch overwrite earlier ones as a sequential pass would
+        position = np.arange(seen + fill, seen + len(batch))
+        slot = (rng.random_sample(len(position)) * (position + 1)).astype(np.int64)
+        keep = slot < n
+        reservoir[slot[keep]] = batch[fill:][keep]
+        seen += len(batch)
+    if reservoir is None:
+        return None
+    return reservoir[:min(n, seen)]
+
+def cross_entropy_error(predict_score, label):
+    return nn.functional.cross_entropy(predict_score, label, reduction='none')
+
+def zero_one_error(predict_score, label):
+    return (predict_score.argmax(dim=1) != label).float()
+
+def top_k_error(predict_score, label, k=5):
+    top_k = predict_score.topk(min(k, predict_score.shape[1]), dim=1)[1]
+    return (top_k != label.unsqueeze(1)).all(dim=1).float()
+
+ERROR_FUNCTIONS = {
+    'cross_entropy': cross_entropy_error,
+    'zero_one': zero_one_error,
+    'top_k': top_k_error,
+}
+
+def predict_errors(predict_score, label, error_type='cross_entropy', **kwargs):
+    """
+    Per-sample error of a whole batch of predictions, in float32 and without grad
+    :param predict_score: shape [N, C], the predicted scores (a tensor or a numpy array)
+    :param label: shape [N] ground truth labels, or one int shared by the batch
+    :param error_type: a name in ERROR_FUNCTIONS or a callable(predict_score, label) returning [N] errors
+    :param kwargs: passed to the error function, e.g. k for 'top_k'
+    :return: shape [N] float32 tensor
+    """
+    error_function = ERROR_FUNCTIONS[error_type] if isinstance(error_type, str) else error_type
+    with torch.inference_mode():
+        predict_score = torch.as_tensor(predict_score).float()
+        if np.ndim(label) == 0:
+            label = torch.full((predict_score.shape[0],), int(label), dtype=torch.int64, device=predict_score.device)
+        else:
+            label = torch.as_tensor(label, dtype=torch.int64, device=predict_score.device)
+        return error_function(predict_score, label, **kwargs).float()
 
 def predict_loss(cls, y_pre): #requires how the loss is calculated for the preduct value and the ground truth value
     """
     Calculate the cross entropy loss for prediction of one picture
-    :param y:
-    :param y_pre:
+    :param cls: ground truth class
+    :param y_pre: shape [1, C], predicted score
     :return:
     """
-    cls_torch = np.full(1, cls)
-    pre_cls_torch = torch.from_numpy(y_pre.astype(float))
-    entropy = nn.CrossEntropyLoss()
-    return entropy(pre_cls_torch, cls_torch)
+    return predict_errors(y_pre, int(cls))[0]
 # def val_split(validation_path):
 #     """
 #     return the validation data and the ground truth value of the validation data
@@ -181,7 +577,67 @@ def predict_loss(cls, y_pre): #requires how the loss is calculated for the predu
 # #             index = i
 # #     return index
 
-def get_label_list(target_list, predict_network, resize_size, crop_size, batch_size):
+def pseudo_label(predict_network, target_list, resize_size, crop_size, batch_size, cache_dir=None, network_key=None,
+                 ten_crop=False):
+    """
+    Predict the label of every target image with ordered, batched inference and the test transform
+    :param predict_network: network to perdict label for target image
+    :param target_list: list of "path label" lines, the label is ignored
+    :param resize_size:
+    :param crop_size:
+    :param batch_size:
+    :param cache_dir: directory of label arrays keyed by the model hash and by a hash of the target paths;
+    when the list only had lines appended since a cached call, only the new lines are labelled and the array of
+    that call is replaced by the longer one
+    :param network_key: network_hash(predict_network), computed from the weights if None
+    :param ten_crop: predict from the scores averaged over the ten crops of image_test_10crop_stacked
+    :return: shape [N] int64 array, the label of target_list[i] at i
+    """
+    if ten_crop:
+        transform = prep.image_test_10crop_stacked(resize_size=resize_size, crop_size=crop_size)
+    else:
+        transform = prep.image_test(resize_size=resize_size, crop_size=crop_size)
+    if cache_dir is None:
+        return extract_features(predict_network, target_list, transform, batch_size, output=1).argmax(axis=1)
+
+    if network_key is None:
+        network_key = network_hash(predict_network)
+    digest = hashlib.sha1()
+    digest.update(network_key.encode('utf-8'))
+    digest.update(repr(transform).encode('utf-8'))
+    directory = os.path.join(cache_dir, digest.hexdigest()[:16])
+    known = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+
+    # running hash of the paths, the longest prefix of the list with a cached array is reused
+    digest = hashlib.sha1()
+    n_cached = 0
+    cached_name = None
+    for i, line in enumerate(target_list):
+        digest.update(line.split()[0].encode('utf-8') + b'\n')
+        name = digest.hexdigest() + '.npy'
+        if name in known:
+            n_cached, cached_name = i + 1, name
+
+    labels = np.empty(len(target_list), dtype=np.int64)
+    if cached_name is not None:
+        labels[:n_cached] = np.load(os.path.join(directory, cached_name))
+    if n_cached < len(target_list):
+        labels[n_cached:] = extract_features(predict_network, target_list[n_cached:], transform, batch_size,
+                                             output=1).argmax(axis=1)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, digest.hexdigest())
+        np.save(path + '.tmp.npy', labels)
+        os.replace(path + '.tmp.npy', path + '.npy')
+        if cached_name is not None:
+            # the new array starts with the reused prefix, keep one array per growing list
+            try:
+                os.remove(os.path.join(directory, cached_name))
+            except OSError:
+                pass
+    return labels
+
+def get_label_list(target_list, predict_network, resize_size, crop_size, batch_size, cache_dir=None, ten_crop=False):
     """
     Return the target list with pesudolabel
     :param target_list: list conatinging all target file path and a wrong label
@@ -189,45 +645,255 @@ def get_label_list(target_list, predict_network, resize_size, crop_size, batch_s
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param cache_dir: label cache directory, see pseudo_label
+    :param ten_crop: label from ten-crop averaged scores, see pseudo_label
     :return:
     """
-    label_list = []
-    dsets_tar = ImageList(target_list, transform=prep.image_train(resize_size=resize_size, crop_size=crop_size))
-    dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-    len_train_target = len(dset_loaders_tar)
-    iter_target = iter(dset_loaders_tar)
-    for i in range(len_train_target):
-        input_tar, label_tar = iter_target.next()
-        predict_score = predict_network(input_tar)[1]
-        label = np.argsort(-predict_score)[0]
-        label_list.append(target_list[i][:-2])
-        label_list[i] = label_list[i] + str(label) + "\n"
-    return label_list
-
-def split_set(source_path, class_num, split = 0.4):
-    """
-    Split the source list into a list of list of source and a list of list of validation
-    :param source_path:
-    :param class_num:
-    :param split:
+    labels = pseudo_label(predict_network, target_list, resize_size, crop_size, batch_size, cache_dir=cache_dir,
+                          ten_crop=ten_crop)
+    return [line.split()[0] + ' ' + str(label) + '\n' for line, label in zip(target_list, labels)]
+
+def _forward_batches(network, image_list, transform, batch_size, outputs, batch_transform=None):
+    # one ordered loader over image_list, yielding the requested outputs of every batch as float32 arrays
+    from data_list import ImageList
+    if len(image_list) == 0:
+        return
+    dsets = ImageList(image_list, transform=transform)
+    dset_loaders = util_data.DataLoader(dsets, batch_size=batch_size, shuffle=False, num_workers=4)
+    load_seconds = forward_seconds = 0.0
+    n_bytes = 0
+    try:
+        tick = time.perf_counter()
+        for inputs, _ in dset_loaders:
+            tock = time.perf_counter()
+            load_seconds += tock - tick
+            with torch.inference_mode():
+                if batch_transform is not None:
+                    inputs = batch_transform(inputs)
+                batch = inputs.shape[0]
+                if inputs.dim() == 5:
+                    # [B, crops, C, H, W] from a multi-crop transform, the outputs are averaged over the crops
+                    network_out = network(inputs.flatten(0, 1))
+                else:
+                    network_out = network(inputs)
+                batch_out = [network_out[o].reshape(batch, -1, network_out[o].shape[-1]).mean(dim=1).cpu().numpy()
+                             for o in outputs]
+            n_bytes += sum(out.nbytes for out in batch_out)
+            forward_seconds += time.perf_counter() - tock
+            yield batch_out
+            tick = time.perf_counter()
+    finally:
+        # load is the time spent waiting on the loader workers, forward the rest of every batch
+        tracer = get_tracer()
+        tracer.record('load', load_seconds, images=len(dsets))
+        tracer.record('forward', forward_seconds, images=len(dsets))
+        tracer.count('images', len(dsets))
+        tracer.count('feature_bytes', n_bytes)
+
+def _regroup(batches, sizes, n_outputs):
+    # cut a stream of batch outputs into consecutive groups of sizes rows, yielding every group once it is full
+    batches = iter(batches)
+    batch, offset = None, 0
+    dims = [0] * n_outputs
+    for size in sizes:
+        group = None
+        filled = 0
+        while filled < size:
+            if batch is None or offset == len(batch[0]):
+                batch, offset = next(batches), 0
+                dims = [out.shape[1] for out in batch]
+            if group is None:
+                group = [np.empty((size, dim), dtype=np.float32) for dim in dims]
+            take = min(size - filled, len(batch[0]) - offset)
+            for result, out in zip(group, batch):
+                result[filled:filled + take] = out[offset:offset + take]
+            filled += take
+            offset += take
+        yield group if group is not None else [np.empty((0, dim), dtype=np.float32) for dim in dims]
+    # let the pass finish, so the loader shuts down and the timings are recorded
+    next(batches, None)
+
+def extract_features(network, image_list, transform, batch_size, output=0, cache=None, network_key=None,
+                     batch_transform=None):
+    """
+    Run the network over the images of image_list in one batched, ordered pass
+    :param network: network returning a tuple, e.g. (feature, predict_score)
+    :param image_list: list of "path label" lines
+    :param transform: transform applied to every image; a multi-crop transform returning [crops, C, H, W]
+    (image_test_10crop_stacked) gives outputs averaged over the crops
+    :param batch_size:
+    :param output: index of the network output to return (0 for the feature, 1 for the predict score),
+    or a tuple of indices to get several outputs from the same pass
+    :param cache: FeatureCache, images already stored in it skip decoding and the forward pass
+    :param network_key: network_hash(network), computed from the weights if None
+    :param batch_transform: transform applied to every collated batch in this process, e.g. the batch half of
+    prep.image_train_batch when the workers return uint8 images
+    :return: shape [N, d] float32 array, or a tuple of them when output is a tuple
+    """
+    return next(extract_grouped_features(network, [image_list], transform, batch_size, output, cache, network_key,
+                                         batch_transform))
+
+def extract_grouped_features(network, groups, transform, batch_size, output=0, cache=None, network_key=None,
+                             batch_transform=None):
+    """
+    extract_features of every group of lines in turn, from a single ordered loader over all of them
+    The loader workers start once rather than once per group, and the outputs of a group are yielded as soon as
+    its last batch is through, so the caller can use them while the next groups load.
+    :param groups: list of lists of "path label" lines, e.g. the images of every class
+    the other parameters are those of extract_features
+    :return: generator of what extract_features returns for every group, in order
+    """
+    outputs = output if isinstance(output, tuple) else (output,)
+    paths = [[line.split()[0] for line in lines] for lines in groups]
+    if cache is None:
+        missing = [list(range(len(lines))) for lines in groups]
+    else:
+        key = transform if batch_transform is None else (transform, batch_transform)
+        namespaces = [cache.namespace(network, key, o, network_key) for o in outputs]
+        missing = [cache.missing(namespaces, group_paths) for group_paths in paths]
+    stream = _forward_batches(network, [lines[i] for lines, rows in zip(groups, missing) for i in rows], transform,
+                              batch_size, outputs, batch_transform)
+    computed = _regroup(stream, [len(rows) for rows in missing], len(outputs))
+    for group_paths, rows, results in zip(paths, missing, computed):
+        if cache is not None and len(group_paths) > 0:
+            # every output is computed by the same pass, the cache of each takes the rows it misses from it
+            position = dict((i, row) for row, i in enumerate(rows))
+            results = [cache.get(namespace, group_paths,
+                                 lambda positions, result=result: result[[position[i] for i in positions]])
+                       for namespace, result in zip(namespaces, results)]
+        yield tuple(results) if isinstance(output, tuple) else results[0]
+
+def class_dev_risk(src_feature, tar_feature, val_feature, error, weight_kwargs=None):
+    """
+    DEV risk of one class: importance weights of its validation samples, then the weighted risk
+    :param src_feature: shape [N_tr, d]
+    :param tar_feature: shape [N_te, d]
+    :param val_feature: shape [N_v, d]
+    :param error: shape [N_v, 1]
+    :param weight_kwargs: keyword arguments for get_weight
     :return:
     """
-    source_list = open(source_path).readlines()
-    src_list = []
-    val_list = []
-    for i in range(class_num):
-        src_list.append([j for j in source_list if int(j.split(" ")[1].replace("\n", "")) == i])
-    for j in range(len(src_list)):
-        val = []
-        source_len = len(src_list[j])
-        val_len = math.ceil(source_len * split)
-        for k in range(val_len):
-            val.append(src_list[i][-1])
-            src_list[i].remove(src_list[i][-1])
-        val_list.append(val_len)
-    return src_list, val_list
-
-def cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num, resize_size, crop_size, batch_size):
+    tracer = get_tracer()
+    with tracer.span('weight'):
+        weight = get_weight(src_feature, tar_feature, val_feature, **(weight_kwargs or {}))
+    with tracer.span('risk'):
+        return get_dev_risk(weight, error)
+
+def _class_dev_risk_in_worker(cls, src_feature, tar_feature, val_feature, error, weight_kwargs, trace_path):
+    # a worker appends to the parent's JSON lines file when it has one
+    tracer = Tracer(trace_path) if trace_path is not None else get_tracer()
+    try:
+        with use_tracer(tracer), tracer.span('class', cls=cls):
+            return class_dev_risk(src_feature, tar_feature, val_feature, error, weight_kwargs)
+    finally:
+        if trace_path is not None:
+            tracer.close()
+
+def _class_dev_risk_from_disk(cls, feature_dir, src_rows, tar_rows, val_rows, weight_kwargs, trace_path):
+    # runs in a worker process, the split arrays are memory-mapped rather than pickled
+    def load(name, rows):
+        return np.load(os.path.join(feature_dir, name + '.npy'), mmap_mode='r')[rows]
+    return _class_dev_risk_in_worker(cls, load('source', src_rows), load('target', tar_rows),
+                                     load('validation', val_rows), load('error', val_rows), weight_kwargs, trace_path)
+
+def parallel_class_dev_risk(src_feature_all, tar_feature_all, val_feature_all, error_all, src_rows, tar_rows, val_rows,
+                            n_jobs, weight_kwargs=None, tmp_dir=None):
+    """
+    class_dev_risk of every class on a process pool
+    The split arrays are written once as .npy files that every worker memory-maps, so only the row indices
+    of a class are sent to a worker. Classes are submitted largest first, since they take longest.
+    :param src_feature_all: shape [N_tr, d], features of the whole source split
+    :param tar_feature_all: shape [N_te, d], features of the whole target split
+    :param val_feature_all: shape [N_v, d], features of the whole validation split
+    :param error_all: shape [N_v, 1], validation errors
+    :param src_rows: list of per-class row indices into src_feature_all, as returned by class_index
+    :param tar_rows:
+    :param val_rows:
+    :param n_jobs: number of processes
+    :param weight_kwargs: keyword arguments for get_weight
+    :param tmp_dir: directory for the memory-mapped arrays, the system default if None
+    :return: list of the DEV risk of every class, in class order
+    """
+    feature_dir = tempfile.mkdtemp(prefix='dev_features_', dir=tmp_dir)
+    try:
+        for name, array in (('source', src_feature_all), ('target', tar_feature_all),
+                            ('validation', val_feature_all), ('error', error_all)):
+            np.save(os.path.join(feature_dir, name + '.npy'), array)
+        class_num = len(src_rows)
+        order = sorted(range(class_num), key=lambda cls: len(src_rows[cls]) + len(tar_rows[cls]), reverse=True)
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = dict((cls, executor.submit(_class_dev_risk_from_disk, cls, feature_dir, src_rows[cls],
+                                                 tar_rows[cls], val_rows[cls], weight_kwargs, get_tracer().path))
+                           for cls in order)
+            return [futures[cls].result() for cls in range(class_num)]
+    finally:
+        shutil.rmtree(feature_dir, ignore_errors=True)
+
+def pipelined_class_dev_risk(produce, class_num, n_jobs=1, weight_kwargs=None, queue_size=2):
+    """
+    class_dev_risk of every class, with the features of the next classes produced while a class is fitted
+    A producer thread calls produce for the classes in order and hands the results over a queue of at most
+    queue_size classes, so the loaders and the forward pass keep running while get_weight fits the domain
+    classifiers; with n_jobs > 1 up to n_jobs classes are fitted at once on a process pool.
+    :param produce: callable taking a class and returning (src_feature, tar_feature, val_feature, error)
+    :param class_num:
+    :param n_jobs: number of processes estimating the weights and risks, 1 fits in this process
+    :param weight_kwargs: keyword arguments for get_weight
+    :param queue_size: number of produced classes waiting for a fit, bounds the features held in memory
+    :return: list of the DEV risk of every class, in class order
+    """
+    queue = Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            for cls in range(class_num):
+                if stop.is_set():
+                    return
+                queue.put((cls, produce(cls)))
+        except BaseException as e:
+            queue.put((None, e))
+            return
+        queue.put((None, None))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    risks = [None] * class_num
+    # the workers start on the first submit, while the producer thread is running
+    executor = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context(_THREAD_SAFE_START)) \
+        if n_jobs > 1 else None
+    pending = {}
+    try:
+        while True:
+            cls, item = queue.get()
+            if cls is None:
+                if item is not None:
+                    raise item
+                break
+            if executor is None:
+                with get_tracer().span('class', cls=cls):
+                    risks[cls] = class_dev_risk(*item, weight_kwargs=weight_kwargs)
+                continue
+            if len(pending) >= n_jobs:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    risks[pending.pop(future)] = future.result()
+            pending[executor.submit(_class_dev_risk_in_worker, cls, *item, weight_kwargs=weight_kwargs,
+                                    trace_path=get_tracer().path)] = cls
+        for future, cls in pending.items():
+            risks[cls] = future.result()
+    finally:
+        stop.set()
+        # unblock a producer waiting on a full queue
+        while thread.is_alive():
+            while not queue.empty():
+                queue.get_nowait()
+            thread.join(timeout=0.1)
+        if executor is not None:
+            executor.shutdown()
+    return risks
+
+def cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num, resize_size, crop_size, batch_size, feature_cache=None, error_type='cross_entropy', label_cache=None, ten_crop=False, uint8_batches=False, n_class_jobs=1, weight_kwargs=None, tracer=None, pipelined=False, queue_size=2):
     """
     Main function for computing the CV loss
     :param feature_network:
@@ -239,77 +905,141 @@ def cross_validation_loss(feature_network, predict_network, src_cls_list, target
     :param resize_size:
     :param crop_size:
     :param batch_size:
+    :param feature_cache: FeatureCache or directory, reuses features across calls sharing the network weights
+    :param error_type: validation error, a name in ERROR_FUNCTIONS or a callable, see predict_errors
+    :param label_cache: directory caching the target pseudolabels, see pseudo_label
+    :param ten_crop: compute the pseudolabels and the validation scores from ten crops of one decoded image
+    :param uint8_batches: the loader workers return uint8 images and crop, flip and normalisation run on whole
+    batches (prep.image_train_batch)
+    :param n_class_jobs: number of processes estimating the weights and risks of the classes in parallel
+    :param weight_kwargs: keyword arguments for get_weight, e.g. {'estimator': 'ensemble'}
+    :param tracer: metrics.Tracer receiving the stage timings, events and counters, get_tracer() if None
+    :param pipelined: extract the features class by class in a background thread while the earlier classes are
+    fitted, see pipelined_class_dev_risk; the target is still pseudolabelled first, since its classes depend on it
+    :param queue_size: number of classes extracted ahead of the fits when pipelined
     :return:
     """
-    # src_cls_list, val_cls_list = split_set(ori_source_list, class_num)
-    # source_list = open(source_path).readlines()
+    tracer = tracer or get_tracer()
+    with use_tracer(tracer):
+        loss = _cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list,
+                                      class_num, resize_size, crop_size, batch_size, feature_cache, error_type,
+                                      label_cache, ten_crop, uint8_batches, n_class_jobs, weight_kwargs, tracer,
+                                      pipelined, queue_size)
+    tracer.flush()
+    return loss
+
+def _cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list, class_num,
+                           resize_size, crop_size, batch_size, feature_cache, error_type, label_cache, ten_crop,
+                           uint8_batches, n_class_jobs, weight_kwargs, tracer, pipelined, queue_size):
     target_list_no_label = open(target_path).readlines()
-    # validation_list = open(val_path).readlines()
-    # src_cls_list = []
-    tar_cls_list = []
-    # val_cls_list = []
+    from data_list import list_labels
     cross_val_loss = 0
 
     # add pesudolabel for target data
-    target_list = get_label_list(target_list_no_label)
-
-    # seperate the class
-    for i in range(class_num):
-        # src_cls_list.append([j for j in source_list if int(j.split(" ")[1].replace("\n", "")) == i])
-        tar_cls_list.append([j for j in target_list if int(j.split(" ")[1].replace("\n", "")) == i])
-        # val_cls_list.append([j for j in validation_list if int(j.split(" ")[1].replace("\n", "")) == i])
-    prep_dict_val = prep_dict_source = prep_dict_target = prep.image_train(resize_size=resize_size, crop_size=crop_size)
-    # load different class's image
+    with tracer.span('pseudo_label', images=len(target_list_no_label)):
+        target_list = get_label_list(target_list_no_label, predict_network, resize_size, crop_size, batch_size,
+                                     cache_dir=label_cache, ten_crop=ten_crop)
+
+    # each split is extracted in one pass, the classes are sliced out by row index afterwards
+    source_list = [line for cls_list in src_cls_list for line in cls_list]
+    validation_list = [line for cls_list in val_cls_list for line in cls_list]
+    src_rows = class_index(list_labels(source_list), class_num)
+    tar_rows = class_index(list_labels(target_list), class_num)
+    val_labels = list_labels(validation_list)
+    val_rows = class_index(val_labels, class_num)
+    if uint8_batches:
+        prep_dict_val, batch_transform = prep.image_train_batch(resize_size=resize_size, crop_size=crop_size)
+    else:
+        prep_dict_val, batch_transform = prep.image_train(resize_size=resize_size, crop_size=crop_size), None
+    prep_dict_source = prep_dict_target = prep_dict_val
+
+    if isinstance(feature_cache, str):
+        feature_cache = FeatureCache(feature_cache)
+    feature_key = predict_key = None
+    if feature_cache is not None:
+        # hash the weights once per call instead of once per split
+        feature_key = network_hash(feature_network)
+        predict_key = feature_key if predict_network is feature_network else network_hash(predict_network)
+
+    if pipelined:
+        # one ordered loader over the images sorted by class, cut at the class boundaries as the classes come in
+        class_lines = [[source_list[i] for i in src_rows[cls]] + [target_list[i] for i in tar_rows[cls]] +
+                       [validation_list[i] for i in val_rows[cls]] for cls in range(class_num)]
+        one_pass = predict_network is feature_network and not ten_crop
+        features = extract_grouped_features(feature_network, class_lines, prep_dict_val, batch_size,
+                                            output=(0, 1) if one_pass else 0, cache=feature_cache,
+                                            network_key=feature_key, batch_transform=batch_transform)
+        if not one_pass:
+            val_transform, val_batch_transform = prep_dict_val, batch_transform
+            if ten_crop:
+                val_transform = prep.image_test_10crop_stacked(resize_size=resize_size, crop_size=crop_size)
+                val_batch_transform = None
+            scores = extract_grouped_features(predict_network,
+                                              [lines[len(lines) - len(val_rows[cls]):]
+                                               for cls, lines in enumerate(class_lines)],
+                                              val_transform, batch_size, output=1, cache=feature_cache,
+                                              network_key=predict_key, batch_transform=val_batch_transform)
+
+        def produce(cls):
+            # called for the classes in order, from the producer thread only
+            n_src, n_tar = len(src_rows[cls]), len(tar_rows[cls])
+            with tracer.span('extract', cls=cls, images=len(class_lines[cls])):
+                if one_pass:
+                    feature, score = next(features)
+                    val_score = score[n_src + n_tar:]
+                else:
+                    feature = next(features)
+                    val_score = next(scores)
+                error = predict_errors(val_score, cls, error_type).numpy().reshape(-1, 1)
+            return feature[:n_src], feature[n_src:n_src + n_tar], feature[n_src + n_tar:], error
+
+        risks = pipelined_class_dev_risk(produce, class_num, n_class_jobs, weight_kwargs, queue_size)
+        return sum(risks)/class_num
+
+    # prepare source, target and validation feature
+    with tracer.span('extract', split='source'):
+        src_feature_all = extract_features(feature_network, source_list, prep_dict_source, batch_size,
+                                           cache=feature_cache, network_key=feature_key,
+                                           batch_transform=batch_transform)
+    with tracer.span('extract', split='target'):
+        tar_feature_all = extract_features(feature_network, target_list, prep_dict_target, batch_size,
+                                           cache=feature_cache, network_key=feature_key,
+                                           batch_transform=batch_transform)
+    with tracer.span('extract', split='validation'):
+        # predicted score for validation, from the same pass when one network gives both outputs
+        if ten_crop:
+            val_feature_all = extract_features(feature_network, validation_list, prep_dict_val, batch_size,
+                                               cache=feature_cache, network_key=feature_key,
+                                               batch_transform=batch_transform)
+            ten_crop_transform = prep.image_test_10crop_stacked(resize_size=resize_size, crop_size=crop_size)
+            val_score_all = extract_features(predict_network, validation_list, ten_crop_transform, batch_size,
+                                             output=1, cache=feature_cache, network_key=predict_key)
+        elif predict_network is feature_network:
+            val_feature_all, val_score_all = extract_features(feature_network, validation_list, prep_dict_val,
+                                                              batch_size, output=(0, 1), cache=feature_cache,
+                                                              network_key=feature_key,
+                                                              batch_transform=batch_transform)
+        else:
+            val_feature_all = extract_features(feature_network, validation_list, prep_dict_val, batch_size,
+                                               cache=feature_cache, network_key=feature_key,
+                                               batch_transform=batch_transform)
+            val_score_all = extract_features(predict_network, validation_list, prep_dict_val, batch_size, output=1,
+                                             cache=feature_cache, network_key=predict_key,
+                                             batch_transform=batch_transform)
+
+    # the error of every validation image against its own class, in one batched call
+    with tracer.span('error'):
+        error_all = predict_errors(val_score_all, val_labels, error_type).numpy().reshape(-1, 1)
+
+    if n_class_jobs > 1:
+        risks = parallel_class_dev_risk(src_feature_all, tar_feature_all, val_feature_all, error_all,
+                                        src_rows, tar_rows, val_rows, n_class_jobs, weight_kwargs)
+        return sum(risks)/class_num
+
     for cls in range(class_num):
-        dsets_src = ImageList(src_cls_list[cls], transform=prep_dict_source)
-        dset_loaders_src = util_data.DataLoader(dsets_src, batch_size=batch_size, shuffle=True, num_workers=4)
-
-        dsets_tar = ImageList(tar_cls_list[cls], transform=prep_dict_target)
-        dset_loaders_tar = util_data.DataLoader(dsets_tar, batch_size=batch_size, shuffle=True, num_workers=4)
-
-        dsets_val = ImageList(val_cls_list[cls], transform=prep_dict_val)
-        dset_loaders_val = util_data.DataLoader(dsets_val, batch_size=batch_size, shuffle=True, num_workers=4)
-
-        # prepare source feature
-        iter_src = iter(dset_loaders_src)
-        src_input, src_labels = iter_src.next()
-        # src_feature = feature_network(src_input)
-        src_feature, _ = feature_network(src_input)
-        for count_src in range(len(src_cls_list[cls]) - 1):
-            src_input, src_labels = iter_src.next()
-            # src_feature = feature_network(src_input)
-            src_feature_new, _ = feature_network(src_input)
-            src_feature = np.append(src_feature, src_feature_new, axis=0)
-
-        # prepare target feature
-        iter_tar = iter(dset_loaders_tar)
-        tar_input, tar_labels = iter_tar.next()
-        # tar_feature = feature_network(tar_input)
-        tar_feature, _ = feature_network(tar_input)
-        for count_tar in range(len(tar_cls_list[cls]) - 1):
-            tar_input, tar_labels = iter_tar.next()
-            # tar_feature_new = feature_network(tar_input)
-            tar_feature_new, _ = feature_network(tar_input)
-            tar_feature = np.append(tar_feature, tar_feature_new, axis=0)
-
-        # prepare validation feature and predicted label for validation
-        iter_val = iter(dset_loaders_val)
-        val_input, val_labels = iter_val.next()
-        # val_feature = feature_network(val_input)
-        val_feature, _ = feature_network(val_input)
-        pred_label = predict_network(val_input)[1]
-        w, h = pred_label.shape
-        error = np.zeors(1)
-        error[0] = predict_loss(cls, pred_label.reshape(1, w*h)).numpy()
-        error = error.reshape(1,1)
-        for count_val in range(len(val_cls_list[cls]) - 1):
-            val_input, val_labels = iter_val.next()
-            # val_feature1 = feature_network(val_input)
-            val_feature_new, _ = feature_network(val_input)
-            val_feature = np.append(val_feature, val_feature_new, axis=0)
-            error = np.append(error, [[predict_loss(cls, predict_network(val_input)[1]).numpy()]], axis=0)
-
-        print('The class is {}\n'.format(cls))
-        weight = get_weight(src_feature, tar_feature, val_feature)
-        cross_val_loss = cross_val_loss + get_dev_risk(weight, error)
+        with tracer.span('class', cls=cls):
+            cross_val_loss = cross_val_loss + class_dev_risk(src_feature_all[src_rows[cls]],
+                                                             tar_feature_all[tar_rows[cls]],
+                                                             val_feature_all[val_rows[cls]], error_all[val_rows[cls]],
+                                                             weight_kwargs)
     return cross_val_loss/class_num
@@ -0,0 +1,348 @@
+"""NumPy-only core of DEV: the risk estimators, importance weight post-processing and row splits.
+
+Nothing here imports torch, torchvision, sklearn or PIL, so the risk of cached weights or features can be
+computed (python dev_core.py --help) on machines without the training stack. dev re-exports every name.
+"""
+import argparse
+
+import numpy as np
+
+
+# L2 penalties of the domain classifiers get_weight chooses from
+DECAYS = [1e-1, 3e-2, 1e-2, 3e-3, 1e-3, 3e-4, 1e-4, 3e-5, 1e-5]
+
+
+def get_dev_risk(weight, error):
+    """
+    :param weight: shape [N, 1], the importance weight for N source samples in the validation set
+    :param error: shape [N, 1], the error value for each source sample in the validation set
+    (typically 0 for correct classification and 1 for wrong classification)
+    """
+    N, d = weight.shape
+    _N, _d = error.shape
+    assert N == _N and d == _d, 'dimension mismatch!'
+    weighted_error = weight * error # weight correspond to Ntr/Nts, error correspond to validation error
+    cov = np.cov(np.concatenate((weighted_error, weight), axis=1),rowvar=False)[0][1]
+    var_w = np.var(weight, ddof=1)
+    eta = - cov / var_w
+    return np.mean(weighted_error) + eta * np.mean(weight) - eta
+
+
+def get_dev_risks(weight, errors):
+    """
+    DEV risk of K candidate models sharing the same importance weights, in one vectorised computation
+    :param weight: shape [N, 1], the importance weight for N source samples in the validation set
+    :param errors: shape [N, K], the error value of each validation sample under each of K models
+    :return: shape [K], get_dev_risk(weight, errors[:, k:k+1]) for every k
+    """
+    N, d = weight.shape
+    _N, K = errors.shape
+    assert N == _N and d == 1, 'dimension mismatch!'
+    weighted_error = weight * errors
+    mean_w = np.mean(weight)
+    mean_we = np.mean(weighted_error, axis=0)
+    cov = np.sum((weighted_error - mean_we) * (weight - mean_w), axis=0) / (N - 1)
+    var_w = np.var(weight, ddof=1)
+    eta = - cov / var_w
+    return mean_we + eta * mean_w - eta
+
+
+def bootstrap_dev_risk(weight, errors, n_boot=1000, random_state=None):
+    """
+    Bootstrap replicates of the DEV risk of K candidate models
+    The B resamples are drawn once as a [B, N] matrix of draw counts, and the resampled moments of all B x K
+    replicates are matrix products with it.
+    :param weight: shape [N, 1], the importance weight for N source samples in the validation set
+    :param errors: shape [N, K], the error value of each validation sample under each of K models
+    :param n_boot: number of bootstrap replicates B
+    :param random_state: seed, the global numpy state if None
+    :return: shape [B, K], the DEV risk of every model on every resample
+    """
+    N, d = weight.shape
+    _N, K = errors.shape
+    assert N == _N and d == 1, 'dimension mismatch!'
+    rng = np.random.RandomState(random_state) if random_state is not None else np.random
+    draws = rng.randint(0, N, size=(n_boot, N))
+    counts = np.bincount((draws + N * np.arange(n_boot)[:, None]).ravel(), minlength=n_boot * N)
+    counts = counts.reshape(n_boot, N).astype(np.float64)
+
+    # moments are taken around the full-sample means to keep the power sums well conditioned
+    weight = np.asarray(weight, dtype=np.float64)
+    weighted_error = weight * errors
+    shift_w = weight.mean()
+    shift_we = weighted_error.mean(axis=0)
+    w = weight - shift_w
+    we = weighted_error - shift_we
+    sum_w = counts.dot(w)  # [B, 1]
+    sum_ww = counts.dot(w ** 2)  # [B, 1]
+    sum_we = counts.dot(we)  # [B, K]
+    sum_wwe = counts.dot(w * we)  # [B, K]
+    mean_w = shift_w + sum_w / N
+    mean_we = shift_we + sum_we / N
+    var_w = (sum_ww - sum_w ** 2 / N) / (N - 1)
+    cov = (sum_wwe - sum_w * sum_we / N) / (N - 1)
+    eta = - cov / var_w
+    return mean_we + eta * mean_w - eta
+
+
+def dev_risk_interval(boot_risks, level=0.95):
+    """
+    Percentile confidence interval from bootstrap replicates
+    :param boot_risks: shape [B, K], as returned by bootstrap_dev_risk
+    :param level: coverage of the interval
+    :return: (lower, upper), each of shape [K]
+    """
+    tail = (1 - level) / 2 * 100
+    return np.percentile(boot_risks, tail, axis=0), np.percentile(boot_risks, 100 - tail, axis=0)
+
+
+class DevRiskAccumulator(object):
+    """Streaming DEV risk: running moments of weight and weighted error, updated batch by batch.
+    Partial accumulators from other workers or shards are combined with merge (Chan et al.'s pairwise
+    update), and risk() equals get_dev_risk on the concatenated arrays.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean_weight = 0.0
+        self.mean_weighted_error = 0.0
+        self.m2_weight = 0.0  # sum of squared deviations of weight
+        self.co_moment = 0.0  # sum of products of the deviations of weighted error and weight
+
+    def update(self, weight, error):
+        """
+        Add a batch of validation samples
+        :param weight: shape [B, 1] (or [B]), the importance weight of the batch
+        :param error: shape [B, 1] (or [B]), the error value of the batch
+        :return: self
+        """
+        weight = np.asarray(weight, dtype=np.float64).reshape(-1)
+        error = np.asarray(error, dtype=np.float64).reshape(-1)
+        assert weight.shape == error.shape, 'dimension mismatch!'
+        if len(weight) == 0:
+            return self
+        weighted_error = weight * error
+        batch = DevRiskAccumulator()
+        batch.n = len(weight)
+        batch.mean_weight = weight.mean()
+        batch.mean_weighted_error = weighted_error.mean()
+        batch.m2_weight = ((weight - batch.mean_weight) ** 2).sum()
+        batch.co_moment = ((weighted_error - batch.mean_weighted_error) * (weight - batch.mean_weight)).sum()
+        return self.merge(batch)
+
+    def merge(self, other):
+        """
+        Fold the moments of another accumulator into this one
+        :param other: DevRiskAccumulator
+        :return: self
+        """
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        delta_weight = other.mean_weight - self.mean_weight
+        delta_weighted_error = other.mean_weighted_error - self.mean_weighted_error
+        scale = float(self.n) * other.n / n
+        self.m2_weight += other.m2_weight + delta_weight ** 2 * scale
+        self.co_moment += other.co_moment + delta_weight * delta_weighted_error * scale
+        self.mean_weight += delta_weight * other.n / n
+        self.mean_weighted_error += delta_weighted_error * other.n / n
+        self.n = n
+        return self
+
+    def risk(self):
+        """Return the DEV risk of every sample seen so far, as get_dev_risk computes it."""
+        cov = self.co_moment / (self.n - 1)
+        var_w = self.m2_weight / (self.n - 1)
+        eta = - cov / var_w
+        return self.mean_weighted_error + eta * self.mean_weight - eta
+
+
+def odds_to_weight(domain_out, scale=1.0):
+    """
+    Turn the domain classifier probabilities of validation rows into importance weights
+    :param domain_out: shape [N_v, 2], predict_proba of a classifier trained with 0 for target and 1 for source
+    :param scale: N_s / N_t of the rows the classifier was trained on
+    :return: shape [N_v, 1], scale * p(target | x) / p(source | x)
+    """
+    return domain_out[:, :1] / domain_out[:, 1:] * scale
+
+
+def class_partition(labels, class_num):
+    """Partition row indices by label with one stable argsort instead of one scan per class.
+    Returns (order, offsets): the rows of class c are order[offsets[c]:offsets[c + 1]], in list
+    order. Labels outside [0, class_num) belong to no class."""
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    offsets = np.searchsorted(labels[order], np.arange(class_num + 1))
+    return order, offsets
+
+
+def stratified_split(labels, class_num, split=0.4, seed=None):
+    """Split every class into train and validation rows, ceil(split * n) validation rows per class.
+    With seed None the validation rows are the last rows of the class in list order (what
+    split_set always did), otherwise a random subset drawn with the seed.
+    Returns (train_rows, val_rows), index arrays grouped by class."""
+    labels = np.asarray(labels)
+    if seed is None:
+        order, offsets = class_partition(labels, class_num)
+    else:
+        # a random key per row, the rows of every class sorted by it
+        rng = np.random.RandomState(seed)
+        order = np.lexsort((rng.random_sample(len(labels)), labels))
+        offsets = np.searchsorted(labels[order], np.arange(class_num + 1))
+    counts = np.diff(offsets)
+    val_counts = np.ceil(counts * split).astype(np.int64)
+    rows = order[offsets[0]:offsets[-1]]
+    rank = np.arange(offsets[0], offsets[-1]) - np.repeat(offsets[:-1], counts)
+    if seed is None:
+        is_val = rank >= np.repeat(counts - val_counts, counts)
+    else:
+        is_val = rank < np.repeat(val_counts, counts)
+    return rows[~is_val], rows[is_val]
+
+
+def class_index(labels, class_num):
+    """
+    Group the row indices of a split by label with one stable argsort
+    :param labels: shape [N], the label of every row
+    :param class_num: number of classes in the dataset
+    :return: list of class_num index arrays, the rows of class i in list order
+    """
+    order, offsets = class_partition(labels, class_num)
+    return [order[offsets[i]:offsets[i + 1]] for i in range(class_num)]
+
+
+def random_select_index(N_s, n, labels=None, random_state=None):
+    """
+    Draw n of N_s row indices uniformly at random without replacement
+    :param N_s: number of rows to draw from
+    :param n: number of rows to draw
+    :param labels: shape [N_s], optional class of every row; when given every class gets a share of n
+    proportional to its size (largest remainder rounding)
+    :param random_state: seed, the global numpy state if None
+    :return: shape [n] sorted int64 array, so gathers from a memmap read forward
+    """
+    rng = np.random.RandomState(random_state) if random_state is not None else np.random
+    if labels is None:
+        return np.sort(rng.choice(N_s, size=n, replace=False))
+    labels = np.asarray(labels)
+    classes, counts = np.unique(labels, return_counts=True)
+    quota = counts * n // N_s
+    remainder = counts * n - quota * N_s
+    quota[np.argsort(-remainder, kind='stable')[:n - quota.sum()]] += 1
+    # a random key per row, the rows of every class sorted by it, and the first quota rows of each class kept
+    order = np.lexsort((rng.random_sample(N_s), labels))
+    starts = np.searchsorted(labels[order], classes)
+    rank = np.arange(N_s) - np.repeat(starts, counts)
+    return np.sort(order[rank < np.repeat(quota, counts)])
+
+
+def class_dev_risks(weight, errors, labels=None, class_num=None):
+    """
+    DEV risk of every class of a validation set from its precomputed importance weights
+    :param weight: shape [N, 1] (or [N]), the importance weight of every validation row
+    :param errors: shape [N, K] (or [N]), the error of every validation row under each of K models
+    :param labels: shape [N], the class of every row; the whole set is one class if None
+    :param class_num: number of classes, one more than the largest label if None
+    :return: (counts, risks), shapes [C] and [C, K]; the risks of a class with fewer than two rows are nan
+    """
+    weight = np.asarray(weight, dtype=np.float64).reshape(-1, 1)
+    errors = np.asarray(errors, dtype=np.float64)
+    errors = errors.reshape(len(errors), -1)
+    if labels is None:
+        labels = np.zeros(len(weight), dtype=np.int64)
+    labels = np.asarray(labels)
+    if class_num is None:
+        class_num = int(labels.max()) + 1
+    rows = class_index(labels, class_num)
+    risks = np.full((class_num, errors.shape[1]), np.nan)
+    for cls in range(class_num):
+        if len(rows[cls]) > 1:
+            risks[cls] = get_dev_risks(weight[rows[cls]], errors[rows[cls]])
+    return np.array([len(cls_rows) for cls_rows in rows]), risks
+
+
+def _load(path, labels=False):
+    if path is None:
+        return None
+    # memory mapped, so only the rows of every class are read from a large feature cache
+    array = np.load(path, mmap_mode='r')
+    return np.asarray(array, dtype=np.int64).reshape(-1) if labels else array
+
+
+def _format(values):
+    return ' '.join('{:.6f}'.format(value) for value in values)
+
+
+def _class_weights(args, val_labels, class_num):
+    # the only path that needs the training stack, imported on first use
+    from dev import fit_importance_weight
+    src_rows = class_index(_load(args.source_labels, labels=True), class_num)
+    tar_rows = class_index(_load(args.target_labels, labels=True), class_num)
+    val_rows = class_index(val_labels, class_num)
+    source, target, validation = _load(args.source), _load(args.target), _load(args.validation)
+    weight = np.zeros((len(validation), 1))
+    for cls in range(class_num):
+        if len(val_rows[cls]) == 0:
+            continue
+        model = fit_importance_weight(np.asarray(source[src_rows[cls]], dtype=np.float32),
+                                      np.asarray(target[tar_rows[cls]], dtype=np.float32), decays=args.decays,
+                                      estimator=args.estimator)
+        weight[val_rows[cls]] = model(np.asarray(validation[val_rows[cls]], dtype=np.float32))
+    return weight
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per class and mean DEV risk of cached weights or features.')
+    parser.add_argument('--errors', required=True, help='.npy [N] or [N, K], validation errors of K models')
+    parser.add_argument('--labels', help='.npy [N], class of every validation row; one class if omitted')
+    parser.add_argument('--class-num', type=int, help='number of classes, 1 + the largest label if omitted')
+    parser.add_argument('--weights', help='.npy [N] or [N, 1], importance weights of the validation rows')
+    parser.add_argument('--source', help='.npy [N_s, d] source features, to fit the weights of every class')
+    parser.add_argument('--source-labels', help='.npy [N_s], class of every source row')
+    parser.add_argument('--target', help='.npy [N_t, d] target features')
+    parser.add_argument('--target-labels', help='.npy [N_t], (pseudo) class of every target row')
+    parser.add_argument('--validation', help='.npy [N, d] validation features')
+    parser.add_argument('--estimator', default='mlp', help='importance weight estimator, see dev.fit_importance_weight')
+    parser.add_argument('--decays', type=float, nargs='+', default=DECAYS)
+    parser.add_argument('--bootstrap', type=int, default=0, help='bootstrap replicates of every class risk, 0 for none')
+    parser.add_argument('--level', type=float, default=0.95, help='coverage of the bootstrap interval')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the bootstrap resamples')
+    args = parser.parse_args(argv)
+
+    errors = np.asarray(_load(args.errors), dtype=np.float64)
+    errors = errors.reshape(len(errors), -1)
+    labels = _load(args.labels, labels=True)
+    if labels is None:
+        labels = np.zeros(len(errors), dtype=np.int64)
+    class_num = args.class_num or int(labels.max()) + 1
+    if args.weights is not None:
+        weight = np.asarray(_load(args.weights), dtype=np.float64).reshape(-1, 1)
+    elif None in (args.source, args.source_labels, args.target, args.target_labels, args.validation):
+        parser.error('either --weights or all of --source, --source-labels, --target, --target-labels and '
+                     '--validation are required')
+    else:
+        weight = _class_weights(args, labels, class_num)
+    if not len(weight) == len(errors) == len(labels):
+        parser.error('--errors, --labels and the weights have different numbers of rows')
+
+    counts, risks = class_dev_risks(weight, errors, labels, class_num)
+    rows = class_index(labels, class_num)
+    for cls in range(class_num):
+        line = 'class {}: {} rows, risk {}'.format(cls, counts[cls], _format(risks[cls]))
+        if args.bootstrap > 0 and counts[cls] > 1:
+            boot = bootstrap_dev_risk(weight[rows[cls]], errors[rows[cls]], args.bootstrap, args.seed + cls)
+            lower, upper = dev_risk_interval(boot, args.level)
+            line += ', {:g}% interval {}'.format(100 * args.level, ' '.join(
+                '[{:.6f}, {:.6f}]'.format(low, high) for low, high in zip(lower, upper)))
+        print(line)
+    # cross_validation_loss divides by class_num, which is only defined when every class could be scored
+    scored = ~np.isnan(risks[:, 0])
+    print('mean over {} of {} classes: {}'.format(scored.sum(), class_num, _format(risks[scored].mean(axis=0))))
+    if not scored.all():
+        print('skipped {} classes with fewer than two validation rows: {}'.format(
+            class_num - scored.sum(), ' '.join(str(cls) for cls in np.flatnonzero(~scored))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def ensemble_forward(weights, biases, x):
+    """
+    Args:
+        weights (list): [K, fan_in, fan_out] weight of every layer.
+        biases (list): [K, 1, fan_out] bias of every layer.
+        x (Tensor): [B, d] inputs shared by every member.
+    Returns:
+        Tensor: [K, B] source logits of every member.
+    """
+    h = torch.matmul(x, weights[0]) + biases[0]
+    for weight, bias in zip(weights[1:], biases[1:]):
+        h = torch.baddbmm(bias, F.relu(h), weight)
+    return h.squeeze(-1)
+
+
+class EnsembleMLP(nn.Module):
+    """K independent relu MLPs of the same shape, one per regularisation strength.
+
+    The weights of layer l are stacked into a [K, fan_in, fan_out] tensor, so a forward
+    pass of all members is one batched matmul per layer. Members never share parameters
+    and Adam updates every element on its own, so training the stack is equivalent to
+    training the K networks one after another on the same minibatches.
+    Args:
+        n_members (int): Number of networks K.
+        layer_sizes (sequence): Width of every layer, input first, a single logit last.
+    """
+
+    def __init__(self, n_members, layer_sizes):
+        super(EnsembleMLP, self).__init__()
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for fan_in, fan_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+            # glorot uniform initialisation, as in sklearn's MLPClassifier
+            bound = math.sqrt(6.0 / (fan_in + fan_out))
+            self.weights.append(nn.Parameter(torch.empty(n_members, fan_in, fan_out).uniform_(-bound, bound)))
+            self.biases.append(nn.Parameter(torch.empty(n_members, 1, fan_out).uniform_(-bound, bound)))
+
+    def forward(self, x):
+        return ensemble_forward(list(self.weights), list(self.biases), x)
+
+    def l2_penalty(self):
+        """Return the [K] squared norm of the weights of every member."""
+        return sum((weight ** 2).sum(dim=(1, 2)) for weight in self.weights)
+
+
+class EnsembleMember(object):
+    """One member of a trained EnsembleMLP, with the classifier interface get_weight uses."""
+
+    def __init__(self, model, index, batch_size=4096):
+        self.weights = [weight[index:index + 1].detach().clone() for weight in model.weights]
+        self.biases = [bias[index:index + 1].detach().clone() for bias in model.biases]
+        self.batch_size = batch_size
+
+    def predict_proba(self, feature):
+        """
+        :param feature: shape [N, d]
+        :return: shape [N, 2], the probability of target (column 0) and source (column 1)
+        """
+        source_prob = np.empty(len(feature), dtype=np.float32)
+        with torch.inference_mode():
+            for start in range(0, len(feature), self.batch_size):
+                batch = torch.as_tensor(np.asarray(feature[start:start + self.batch_size], dtype=np.float32))
+                logit = ensemble_forward(self.weights, self.biases, batch)[0]
+                source_prob[start:start + len(batch)] = torch.sigmoid(logit).numpy()
+        return np.stack((1 - source_prob, source_prob), axis=1)
+
+    def predict(self, feature):
+        return (self.predict_proba(feature)[:, 1] > 0.5).astype(np.int32)
+
+
+def train_ensemble(decays, d, hidden_layer_sizes, minibatches, n_samples, learning_rate=1e-3, max_iter=200, tol=1e-4,
+                   n_iter_no_change=10, random_state=None):
+    """
+    Train an EnsembleMLP with one member per decay on a stream of minibatches
+    Mirrors MLPClassifier's defaults (adam, 200 epochs, stop once the epoch loss has not improved by tol for
+    n_iter_no_change epochs); a converged member is frozen while the others keep training.
+    :param decays: the L2 penalties, one ensemble member each
+    :param d: input dimension
+    :param hidden_layer_sizes:
+    :param minibatches: callable returning an iterable of (feature, label) float32 tensor minibatches covering one
+    epoch, label 1 for source and 0 for target; every member sees the same minibatches
+    :param n_samples: number of training rows in an epoch
+    :param learning_rate:
+    :param max_iter: maximum number of epochs
+    :param tol:
+    :param n_iter_no_change:
+    :param random_state: seed of the initialisation
+    :return: EnsembleMLP
+    """
+    if random_state is not None:
+        torch.manual_seed(random_state)
+    K = len(decays)
+    alpha = torch.tensor(decays, dtype=torch.float32)
+
+    model = EnsembleMLP(K, [d] + list(hidden_layer_sizes) + [1])
+    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    active = torch.ones(K, dtype=torch.bool)
+    best_loss = torch.full((K,), float('inf'))
+    no_change = torch.zeros(K, dtype=torch.int64)
+    frozen = [param.detach().clone() for param in model.parameters()]
+
+    for _ in range(max_iter):
+        epoch_loss = torch.zeros(K)
+        for feature, label in minibatches():
+            logit = model(feature)
+            target = label.expand_as(logit)
+            # [K] losses, every member sees the same minibatch
+            loss = F.binary_cross_entropy_with_logits(logit, target, reduction='none').mean(dim=1)
+            loss = loss + 0.5 * alpha * model.l2_penalty() / len(feature)
+            optimizer.zero_grad()
+            loss.sum().backward()
+            optimizer.step()
+            if not active.all():
+                with torch.no_grad():
+                    for param, frozen_param in zip(model.parameters(), frozen):
+                        param[~active] = frozen_param[~active]
+            epoch_loss += loss.detach() * len(feature)
+        epoch_loss /= n_samples
+
+        improved = epoch_loss < best_loss - tol
+        no_change = torch.where(improved, torch.zeros_like(no_change), no_change + 1)
+        best_loss = torch.minimum(best_loss, epoch_loss)
+        converged = active & (no_change >= n_iter_no_change)
+        if converged.any():
+            with torch.no_grad():
+                for param, frozen_param in zip(model.parameters(), frozen):
+                    frozen_param[converged] = param[converged]
+            active &= ~converged
+        if not active.any():
+            break
+    return model
+
+
+def score_ensemble(model, batches):
+    """
+    Held-out accuracy of every member of model
+    :param model: EnsembleMLP
+    :param batches: iterable of (feature, label) numpy chunks of the held-out split
+    :return: list of (val acc, EnsembleMember), one per member
+    """
+    correct = np.zeros(len(model.weights[0]))
+    total = 0
+    with torch.inference_mode():
+        for feature, label in batches:
+            output = (model(torch.as_tensor(np.asarray(feature, dtype=np.float32))) > 0).numpy().astype(np.int32)
+            correct += (output == np.asarray(label)).sum(axis=1)
+            total += len(label)
+    acc = (correct / total).astype(np.float32)
+    return [(acc[k], EnsembleMember(model, k)) for k in range(len(acc))]
+
+
+def fit_ensemble_domain_classifiers(decays, feature_for_train, label_for_train, feature_for_test, label_for_test,
+                                    hidden_layer_sizes, learning_rate=1e-3, batch_size=200, max_iter=200, tol=1e-4,
+                                    n_iter_no_change=10, random_state=None):
+    """
+    Fit one domain classifier per decay as a single batched torch ensemble, see train_ensemble
+    :param decays: the L2 penalties, one ensemble member each
+    :param feature_for_train: shape [N, d]
+    :param label_for_train: shape [N], 1 for source and 0 for target
+    :param feature_for_test:
+    :param label_for_test:
+    :param hidden_layer_sizes:
+    :param learning_rate:
+    :param batch_size:
+    :param max_iter: maximum number of epochs
+    :param tol:
+    :param n_iter_no_change:
+    :param random_state: seed of the initialisation and of the minibatch order
+    :return: list of (val acc, EnsembleMember), one per decay
+    """
+    generator = torch.Generator()
+    if random_state is not None:
+        generator.manual_seed(random_state)
+    feature = torch.as_tensor(np.asarray(feature_for_train, dtype=np.float32))
+    label = torch.as_tensor(np.asarray(label_for_train, dtype=np.float32))
+    N, d = feature.shape
+    batch_size = min(batch_size, N)
+
+    def minibatches():
+        for batch in torch.randperm(N, generator=generator).split(batch_size):
+            yield feature[batch], label[batch]
+
+    model = train_ensemble(decays, d, hidden_layer_sizes, minibatches, N, learning_rate, max_iter, tol,
+                           n_iter_no_change, random_state)
+    # score every member on the held-out split in one pass
+    return score_ensemble(model, ((feature_for_test[start:start + 4096], label_for_test[start:start + 4096])
+                                  for start in range(0, len(feature_for_test), 4096)))
@@ -0,0 +1,106 @@
+import itertools
+import math
+
+import numpy as np
+from sklearn.neural_network import MLPClassifier
+
+
+def search_space(decays, widths=None, learning_rates=None):
+    """
+    Every combination of the candidate settings of a domain classifier
+    :param decays: L2 penalties (MLPClassifier's alpha)
+    :param widths: widths w of the (w, w, 2) hidden layers, the feature dimension if None
+    :param learning_rates: adam learning rates, sklearn's default 1e-3 if None
+    :return: list of config dicts with keys 'alpha', 'width' and 'learning_rate'
+    """
+    return [{'alpha': alpha, 'width': width, 'learning_rate': learning_rate}
+            for alpha, width, learning_rate in itertools.product(decays, widths or [None], learning_rates or [1e-3])]
+
+
+def _new_classifier(config, d, max_iter):
+    width = config['width'] or d
+    return MLPClassifier(hidden_layer_sizes=(width, width, 2), activation='relu', alpha=config['alpha'],
+                         learning_rate_init=config['learning_rate'], max_iter=max_iter, warm_start=True)
+
+
+def successive_halving(configs, feature_for_train, label_for_train, feature_for_test, label_for_test, eta=3,
+                       min_rows=200, max_iter=200, n_rungs=None, trace=None, bracket=0):
+    """
+    Successive halving over domain classifier configs on growing prefixes of the training split
+    Rung r of R trains every surviving config on the first N * eta^(r - R + 1) training rows (at least min_rows)
+    for up to max_iter * eta^(r - R + 1) epochs in total, resuming the model of the previous rung with a fresh
+    tol / n_iter_no_change stopping rule, scores it on the whole held-out split and keeps the best 1 / eta of the
+    configs. The last rung trains the survivors on every row for up to max_iter epochs in total, as a full fit would.
+    :param configs: list of config dicts, see search_space
+    :param feature_for_train: shape [N, d], shuffled, so every prefix is a random subset
+    :param label_for_train: shape [N], 1 for source and 0 for target
+    :param feature_for_test:
+    :param label_for_test:
+    :param eta: fraction of the configs dropped per rung is 1 - 1 / eta
+    :param min_rows: smallest training prefix
+    :param max_iter: epochs of a full fit
+    :param n_rungs: number of rungs, enough to leave one config if None
+    :param trace: list the record of every fit is appended to
+    :param bracket: bracket number written to the trace, see hyperband
+    :return: list of (val acc, domain classifier) of the configs of the last rung
+    """
+    N, d = feature_for_train.shape
+    if n_rungs is None:
+        n_rungs = int(math.floor(math.log(len(configs), eta) + 1e-9)) + 1
+    candidates = [(config, None) for config in configs]
+    for rung in range(n_rungs):
+        fraction = float(eta) ** (rung - n_rungs + 1)
+        rows = min(N, max(min_rows, int(N * fraction)))
+        epochs = max(1, int(round(max_iter * fraction)))
+        scored = []
+        for index, (config, domain_classifier) in enumerate(candidates):
+            if domain_classifier is None:
+                domain_classifier = _new_classifier(config, d, epochs)
+                done = 0
+            else:
+                # n_iter_ restarts at 0 on every fit, loss_curve_ keeps one entry per epoch of every call
+                done = len(domain_classifier.loss_curve_)
+                # the stopping state of the smaller prefix would end the fit after n_iter_no_change epochs
+                domain_classifier._no_improvement_count = 0
+                domain_classifier.best_loss_ = np.inf
+            # with warm_start, max_iter counts the epochs of this call only
+            domain_classifier.set_params(max_iter=max(1, epochs - done))
+            domain_classifier.fit(feature_for_train[:rows], label_for_train[:rows])
+            output = domain_classifier.predict(feature_for_test)
+            acc = np.mean((label_for_test == output).astype(np.float32))
+            scored.append((acc, index, config, domain_classifier))
+            if trace is not None:
+                trace.append({'bracket': bracket, 'rung': rung, 'config': dict(config), 'rows': rows,
+                              'epochs': epochs, 'trained_epochs': len(domain_classifier.loss_curve_),
+                              'val_acc': float(acc)})
+        if rung == n_rungs - 1:
+            return [(acc, domain_classifier) for acc, _, _, domain_classifier in scored]
+        # ties keep the earlier config, as the full sweep's first-max selection does
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        n_keep = max(1, int(math.ceil(len(scored) / float(eta))))
+        candidates = [(config, domain_classifier) for _, _, config, domain_classifier in scored[:n_keep]]
+
+
+def hyperband(configs, feature_for_train, label_for_train, feature_for_test, label_for_test, eta=3, min_rows=200,
+              max_iter=200, trace=None, random_state=None):
+    """
+    Hyperband: successive halving brackets trading the number of configs against their starting budget
+    Bracket s starts ceil((s_max + 1) / (s + 1) * eta^s) configs, drawn from configs without replacement, on
+    s + 1 rungs; bracket 0 trains a few configs on the full budget straight away.
+    :return: list of (val acc, domain classifier) of the last rung of every bracket
+    """
+    rng = np.random.RandomState(random_state) if random_state is not None else np.random
+    s_max = int(math.floor(math.log(len(configs), eta) + 1e-9))
+    results = []
+    for s in range(s_max, -1, -1):
+        n = min(len(configs), int(math.ceil((s_max + 1) / float(s + 1) * eta ** s)))
+        chosen = [configs[i] for i in sorted(rng.choice(len(configs), size=n, replace=False))]
+        results.extend(successive_halving(chosen, feature_for_train, label_for_train, feature_for_test,
+                                          label_for_test, eta, min_rows, max_iter, s + 1, trace, bracket=s))
+    return results
+
+
+SEARCHES = {
+    'halving': successive_halving,
+    'hyperband': hyperband,
+}
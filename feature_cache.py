@@ -0,0 +1,143 @@
+import hashlib
+import os
+import uuid
+
+import numpy as np
+
+
+def network_hash(network):
+    """
+    Return a hex digest of the weights of a network, used to key cached features
+    :param network: a torch.nn.Module (anything with a state_dict)
+    :return:
+    """
+    digest = hashlib.sha1()
+    state = network.state_dict()
+    for name in sorted(state.keys()):
+        tensor = state[name].detach().cpu().contiguous()
+        digest.update(name.encode('utf-8'))
+        digest.update('{}{}'.format(tuple(tensor.shape), tensor.dtype).encode('utf-8'))
+        digest.update(tensor.numpy().tobytes())
+    return digest.hexdigest()
+
+
+class FeatureCache(object):
+    """A persistent feature store on disk, keyed by image path, transform and network weights.
+
+    Every (network, output, transform) combination gets its own namespace directory under
+    root. A namespace holds float32 shards written as ``shard_<id>.npy`` next to a
+    ``shard_<id>.txt`` listing the image path of every row; the ``.txt`` file is written
+    last, so a shard is only visible once it is complete. Shards are read back as memmaps,
+    so a hit costs a page-cache read and no image decoding or forward pass.
+    Args:
+        root (string): Directory holding the namespaces, created if missing.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._indices = {}
+        self._shards = {}
+
+    def namespace(self, network, transform, output=0, network_key=None):
+        """
+        Return the namespace of the features produced by network(transform(image))[output]
+        :param network: network producing the features
+        :param transform: transform applied to the images, keyed by its repr
+        :param output: index of the network output that is cached
+        :param network_key: precomputed weight hash, network_hash(network) if None
+        :return:
+        """
+        if network_key is None:
+            network_key = network_hash(network)
+        digest = hashlib.sha1()
+        digest.update(network_key.encode('utf-8'))
+        digest.update(str(output).encode('utf-8'))
+        digest.update(repr(transform).encode('utf-8'))
+        return digest.hexdigest()[:16]
+
+    def _index(self, namespace):
+        if namespace not in self._indices:
+            index = {}
+            directory = os.path.join(self.root, namespace)
+            if os.path.isdir(directory):
+                for name in sorted(os.listdir(directory)):
+                    if not name.endswith('.txt'):
+                        continue
+                    shard = name[:-len('.txt')]
+                    with open(os.path.join(directory, name)) as f:
+                        for row, path in enumerate(f.read().splitlines()):
+                            index[path] = (shard, row)
+            self._indices[namespace] = index
+        return self._indices[namespace]
+
+    def _shard(self, namespace, shard):
+        key = (namespace, shard)
+        if key not in self._shards:
+            self._shards[key] = np.load(os.path.join(self.root, namespace, shard + '.npy'), mmap_mode='r')
+        return self._shards[key]
+
+    def store(self, namespace, paths, features):
+        """
+        Write the features of paths as a new shard of namespace
+        :param namespace: namespace returned by self.namespace
+        :param paths: list of N image paths
+        :param features: shape [N, d], features of the images in paths
+        :return:
+        """
+        if len(paths) == 0:
+            return
+        directory = os.path.join(self.root, namespace)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        shard = 'shard_' + uuid.uuid4().hex
+        base = os.path.join(directory, shard)
+        np.save(base + '.tmp.npy', np.ascontiguousarray(features, dtype=np.float32))
+        os.replace(base + '.tmp.npy', base + '.npy')
+        with open(base + '.tmp', 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+        os.replace(base + '.tmp', base + '.txt')
+        index = self._index(namespace)
+        for row, path in enumerate(paths):
+            index[path] = (shard, row)
+
+    def missing(self, namespaces, paths):
+        """
+        Return the positions in paths whose features are missing from any of namespaces
+        :param namespaces: list of namespaces returned by self.namespace
+        :param paths: list of N image paths
+        :return: list of positions in paths, in order
+        """
+        indices = [self._index(namespace) for namespace in namespaces]
+        return [i for i, path in enumerate(paths) if any(path not in index for index in indices)]
+
+    def get(self, namespace, paths, compute):
+        """
+        Return the features of paths, computing and storing only the ones not cached yet
+        :param namespace: namespace returned by self.namespace
+        :param paths: list of N image paths
+        :param compute: callable taking a list of positions in paths and returning their
+        features, shape [len(positions), d]
+        :return: shape [N, d] float32 array, in the order of paths
+        """
+        index = self._index(namespace)
+        hits = [i for i, path in enumerate(paths) if path in index]
+        missing = [i for i, path in enumerate(paths) if path not in index]
+        if len(missing) > 0:
+            missing_feature = np.asarray(compute(missing), dtype=np.float32)
+            self.store(namespace, [paths[i] for i in missing], missing_feature)
+            d = missing_feature.shape[1]
+        else:
+            missing_feature = None
+            d = self._shard(namespace, index[paths[0]][0]).shape[1]
+
+        features = np.empty((len(paths), d), dtype=np.float32)
+        if missing_feature is not None:
+            features[missing] = missing_feature
+        if len(hits) > 0:
+            hits = np.asarray(hits)
+            shards = np.asarray([index[paths[i]][0] for i in hits])
+            rows = np.asarray([index[paths[i]][1] for i in hits])
+            for shard in np.unique(shards):
+                mask = shards == shard
+                features[hits[mask]] = self._shard(namespace, shard)[rows[mask]]
+        return features
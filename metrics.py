@@ -0,0 +1,170 @@
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return str(value)
+
+
+class Tracer(object):
+    """Timing spans, events and counters of a model selection run, written as JSON lines.
+
+    Every record is one JSON object per line with a ``type`` ("span", "event" or
+    "counters"), a ``name`` and the fields of the spans it is nested in, so the records
+    of a class carry its ``cls``; the nesting is tracked per thread. Counters (images,
+    bytes, rows) are summed over the run and written by flush. Spans named in
+    profile_stages also run under cProfile or torch.profiler and leave
+    ``<name>-<n>.prof`` or ``<name>-<n>.json`` files in profile_dir; only one profiler
+    runs at a time, so a span nested in a profiled one is part of its profile.
+    Args:
+        sink (string or file): JSON lines file, appended to; a path or an open file. Nothing is written if None.
+        profile (string): None, 'cprofile' or 'torch'.
+        profile_stages (sequence): Names of the spans to profile, all of them if None.
+        profile_dir (string): Directory of the profiles, created if missing.
+    """
+
+    def __init__(self, sink=None, profile=None, profile_stages=None, profile_dir='profiles'):
+        if profile not in (None, 'cprofile', 'torch'):
+            raise ValueError('unknown profiler: {}'.format(profile))
+        self._owns_sink = isinstance(sink, str)
+        self.path = sink if self._owns_sink else None
+        # line buffered, so worker processes appending to the same file write whole lines
+        self.sink = open(sink, 'a', buffering=1) if self._owns_sink else sink
+        self.profile = profile
+        self.profile_stages = None if profile_stages is None else set(profile_stages)
+        self.profile_dir = profile_dir
+        self.counters = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._n_profiles = 0
+        self._profiling = False
+
+    @property
+    def _context(self):
+        return getattr(self._local, 'context', {})
+
+    @_context.setter
+    def _context(self, context):
+        self._local.context = context
+
+    def _write(self, record):
+        if self.sink is not None:
+            line = json.dumps(record, default=_to_json) + '\n'
+            with self._lock:
+                self.sink.write(line)
+
+    def event(self, name, **fields):
+        """Record a point event, e.g. the score of one decay."""
+        record = {'type': 'event', 'name': name, 'time': time.time()}
+        record.update(self._context)
+        record.update(fields)
+        self._write(record)
+
+    def record(self, name, seconds, **fields):
+        """Record a span timed elsewhere, e.g. the total of many small intervals."""
+        record = {'type': 'span', 'name': name, 'seconds': seconds}
+        record.update(self._context)
+        record.update(fields)
+        self._write(record)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """
+        Time the enclosed block as a span; fields are recorded with it and with every record nested in it
+        :param name: stage name, e.g. 'extract' or 'fit'
+        :param fields: extra fields, e.g. cls=3
+        """
+        outer = self._context
+        self._context = dict(outer, **fields)
+        start = time.perf_counter()
+        try:
+            with self._profiler(name):
+                yield
+        finally:
+            seconds = time.perf_counter() - start
+            self._context = outer
+            self.record(name, seconds, **fields)
+
+    @contextlib.contextmanager
+    def _profiler(self, name):
+        if self.profile is None or (self.profile_stages is not None and name not in self.profile_stages):
+            yield
+            return
+        # one profiler at a time: a nested one would take over the outer one's hook (and raise on 3.12+),
+        # so spans inside a profiled span, or running in another thread meanwhile, show up in its profile
+        with self._lock:
+            busy = self._profiling
+            if not busy:
+                self._profiling = True
+                self._n_profiles += 1
+                n = self._n_profiles
+        if busy:
+            yield
+            return
+        try:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            base = os.path.join(self.profile_dir, '{}-{}'.format(name, n))
+            if self.profile == 'cprofile':
+                profiler = cProfile.Profile()
+                profiler.enable()
+                try:
+                    yield
+                finally:
+                    profiler.disable()
+                    profiler.dump_stats(base + '.prof')
+            else:
+                import torch.profiler
+                with torch.profiler.profile(record_shapes=True) as profiler:
+                    yield
+                profiler.export_chrome_trace(base + '.json')
+        finally:
+            self._profiling = False
+
+    def flush(self):
+        """Write the counters summed so far and flush the sink."""
+        record = {'type': 'counters', 'time': time.time()}
+        with self._lock:
+            record.update(self.counters)
+        self._write(record)
+        if self.sink is not None:
+            self.sink.flush()
+
+    def close(self):
+        self.flush()
+        if self._owns_sink:
+            self.sink.close()
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """Return the tracer of the current run, a Tracer without a sink unless use_tracer is active."""
+    return _tracer
+
+
+@contextlib.contextmanager
+def use_tracer(tracer):
+    """Make tracer the one get_tracer returns inside the block."""
+    global _tracer
+    outer = _tracer
+    _tracer = tracer
+    try:
+        yield tracer
+    finally:
+        _tracer = outer
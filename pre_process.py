@@ -3,7 +3,9 @@ from torchvision import transforms
 import os
 from PIL import Image, ImageOps
 import numbers
+import math
 import torch
+import torch.nn.functional as F
 
 class ResizeImage():
     def __init__(self, size):
@@ -13,7 +15,12 @@ class ResizeImage():
         self.size = size
     def __call__(self, img):
       th, tw = self.size
+      if img.size == (th, tw):
+        # already resized, e.g. read from an image shard
+        return img
       return img.resize((th, tw))
+    def __repr__(self):
+      return self.__class__.__name__ + '(size={})'.format(self.size)
 
 
 class PlaceCrop(object):
@@ -42,6 +49,10 @@ class PlaceCrop(object):
         th, tw = self.size
         return img.crop((self.start_x, self.start_y, self.start_x + tw, self.start_y + th))
 
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={}, start_x={}, start_y={})'.format(
+            self.size, self.start_x, self.start_y)
+
 
 class ForceFlip(object):
     """Horizontally flip the given PIL.Image randomly with a probability of 0.5."""
@@ -55,6 +66,168 @@ class ForceFlip(object):
         """
         return img.transpose(Image.FLIP_LEFT_RIGHT)
 
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+class StackedTenCrop(object):
+    """Ten crops of one normalised tensor, stacked into a single tensor.
+    The crops are slices of the image and of its horizontal flip, in the order of the val0..val9
+    pipelines of image_test_10crop, with the same pixel offsets PlaceCrop gives.
+    """
+
+    def __init__(self, size, resize_size):
+        if isinstance(size, int):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        start_first = 0
+        start_center = (resize_size - self.size[0] - 1) / 2
+        start_last = resize_size - self.size[0] - 1
+        corners = [(start_first, start_first), (start_last, start_last), (start_last, start_first),
+                   (start_first, start_last), (start_center, start_center)]
+        # flipped crops first, as val0..val4
+        self.crops = [(True, x, y) for x, y in corners] + [(False, x, y) for x, y in corners]
+
+    def __call__(self, tensor):
+        """
+        Args:
+            tensor (Tensor): [C, H, W] image.
+        Returns:
+            Tensor: [10, C, h, w] crops.
+        """
+        th, tw = self.size
+        flipped = tensor.flip(-1)
+        crops = []
+        for flip, x, y in self.crops:
+            # PIL rounds fractional crop boxes, do the same
+            x0, y0 = int(round(x)), int(round(y))
+            x1, y1 = int(round(x + tw)), int(round(y + th))
+            crops.append((flipped if flip else tensor)[:, y0:y1, x0:x1])
+        return torch.stack(crops)
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={}, crops={})'.format(self.size, self.crops)
+
+class ToUint8Tensor(object):
+    """Convert a PIL.Image to a uint8 [H, W, C] tensor, without scaling or normalising.
+    Uint8 tensors are a quarter of the bytes of float32 ones between DataLoader workers and the main
+    process; the float conversion happens on the collated batch (BatchRandomResizedCrop, BatchCenterCrop).
+    """
+
+    def __call__(self, img):
+        if isinstance(img, torch.Tensor):
+            return img
+        return torch.from_numpy(np.array(img, dtype=np.uint8, copy=True))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+class BatchNormalize(object):
+    """Convert a collated uint8 [B, H, W, C] batch to a normalised float [B, C, H, W] batch,
+    the batch equivalent of ToTensor followed by Normalize."""
+
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.mean = torch.tensor(mean).view(1, -1, 1, 1)
+        self.std = torch.tensor(std).view(1, -1, 1, 1)
+
+    def to_float(self, batch):
+        return batch.permute(0, 3, 1, 2).float().div_(255)
+
+    def normalize(self, batch):
+        return (batch - self.mean) / self.std
+
+    def __call__(self, batch):
+        return self.normalize(self.to_float(batch))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(mean={}, std={})'.format(self.mean.view(-1).tolist(), self.std.view(-1).tolist())
+
+
+class BatchRandomResizedCrop(BatchNormalize):
+    """RandomResizedCrop, RandomHorizontalFlip, ToTensor and Normalize for a whole collated uint8
+    [B, H, W, C] batch. Every image gets its own crop box and flip, folded into one affine sampling
+    grid, so the batch is resampled by a single bilinear grid_sample.
+    The crop area and aspect ratio are drawn as RandomResizedCrop draws them, but a box larger
+    than the image is clamped to it instead of redrawn.
+    """
+
+    def __init__(self, size, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), mean=(0.485, 0.456, 0.406),
+                 std=(0.229, 0.224, 0.225), generator=None):
+        super(BatchRandomResizedCrop, self).__init__(mean, std)
+        if isinstance(size, int):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.generator = generator
+
+    def _uniform(self, n, low, high):
+        return torch.rand(n, generator=self.generator) * (high - low) + low
+
+    def __call__(self, batch):
+        x = self.to_float(batch)
+        B, C, H, W = x.shape
+        area = H * W * self._uniform(B, self.scale[0], self.scale[1])
+        aspect = torch.exp(self._uniform(B, math.log(self.ratio[0]), math.log(self.ratio[1])))
+        w = torch.sqrt(area * aspect).clamp(max=W)
+        h = torch.sqrt(area / aspect).clamp(max=H)
+        x0 = torch.rand(B, generator=self.generator) * (W - w)
+        y0 = torch.rand(B, generator=self.generator) * (H - h)
+        flip = torch.rand(B, generator=self.generator) < 0.5
+
+        # affine map from output coordinates in [-1, 1] to input coordinates in [-1, 1]
+        theta = torch.zeros(B, 2, 3)
+        theta[:, 0, 0] = torch.where(flip, -w / W, w / W)
+        theta[:, 0, 2] = (2 * x0 + w) / W - 1
+        theta[:, 1, 1] = h / H
+        theta[:, 1, 2] = (2 * y0 + h) / H - 1
+        grid = F.affine_grid(theta, (B, C, self.size[0], self.size[1]), align_corners=False)
+        return self.normalize(F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={}, scale={}, ratio={})'.format(self.size, self.scale, self.ratio)
+
+
+class BatchCenterCrop(BatchNormalize):
+    """The center crop of image_test (PlaceCrop at the same offset) with ToTensor and Normalize,
+    as one slice of a collated uint8 [B, H, W, C] batch."""
+
+    def __init__(self, size, resize_size, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(BatchCenterCrop, self).__init__(mean, std)
+        if isinstance(size, int):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        self.start = (resize_size - self.size[0] - 1) / 2
+
+    def __call__(self, batch):
+        th, tw = self.size
+        # PIL rounds fractional crop boxes, do the same
+        x0 = y0 = int(round(self.start))
+        x1, y1 = int(round(self.start + tw)), int(round(self.start + th))
+        return self.normalize(self.to_float(batch[:, y0:y1, x0:x1]))
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(size={}, start={})'.format(self.size, self.start)
+
+
+def image_uint8(resize_size=256):
+  #per-image part of image_train_batch and image_test_batch, run in the DataLoader workers
+  return transforms.Compose([
+    ResizeImage(resize_size),
+    ToUint8Tensor()
+  ])
+
+def image_train_batch(resize_size=256, crop_size=224):
+  #(per-image transform, batch transform) pair equivalent to image_train
+  return image_uint8(resize_size), BatchRandomResizedCrop(crop_size)
+
+def image_test_batch(resize_size=256, crop_size=224):
+  #(per-image transform, batch transform) pair equivalent to image_test
+  return image_uint8(resize_size), BatchCenterCrop(crop_size, resize_size)
+
 def image_train(resize_size=256, crop_size=224):
   normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                    std=[0.229, 0.224, 0.225])
@@ -81,6 +254,18 @@ def image_test(resize_size=256, crop_size=224):
     normalize
   ])
 
+def image_test_10crop_stacked(resize_size=256, crop_size=224):
+  normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                                   std=[0.229, 0.224, 0.225])
+  #the same ten crops as image_test_10crop from one decode and resize; normalising before cropping
+  #gives the same pixels as normalising every crop
+  return transforms.Compose([
+    ResizeImage(resize_size),
+    transforms.ToTensor(),
+    normalize,
+    StackedTenCrop(crop_size, resize_size)
+  ])
+
 def image_test_10crop(resize_size=256, crop_size=224):
   normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                    std=[0.229, 0.224, 0.225])
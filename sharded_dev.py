@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import pre_process as prep
+from data_list import list_labels
+from dev import (DevRiskAccumulator, class_index, extract_features, fit_importance_weight, get_label_list,
+                 predict_errors)
+from feature_cache import FeatureCache, network_hash
+from metrics import get_tracer
+
+
+def init_local(rank, world_size, port=29500):
+    """
+    Join a gloo process group on this machine
+    :param rank:
+    :param world_size:
+    :param port: free TCP port of rank 0
+    :return:
+    """
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+
+def _local_worker(rank, world_size, port, fn, args, kwargs, results):
+    init_local(rank, world_size, port)
+    try:
+        result = fn(*args, **kwargs)
+        if rank == 0:
+            results.put(result)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch_local(fn, world_size, args=(), kwargs=None, port=29500):
+    """
+    Run fn(*args, **kwargs) in world_size spawned processes joined in a local gloo group
+    :param fn: module level function, e.g. sharded_cross_validation_loss
+    :param world_size: number of processes
+    :param args:
+    :param kwargs:
+    :param port: free TCP port for the rendezvous
+    :return: the result of rank 0
+    """
+    results = mp.get_context('spawn').SimpleQueue()
+    mp.spawn(_local_worker, args=(world_size, port, fn, args, kwargs or {}, results), nprocs=world_size, join=True)
+    return results.get()
+
+
+def shard_list(image_list, rank, world_size):
+    """Every world_size-th line starting at rank, so every class is spread evenly over the shards."""
+    return image_list[rank::world_size]
+
+
+def sharded_cross_validation_loss(feature_network, predict_network, src_cls_list, target_path, val_cls_list,
+                                  class_num, resize_size, crop_size, batch_size, feature_cache=None,
+                                  error_type='cross_entropy', label_cache=None, weight_kwargs=None,
+                                  max_train_rows=None, seed=0):
+    """
+    cross_validation_loss with the source, target and validation lists sharded over a torch.distributed group
+    Every rank pseudolabels, extracts and scores its own shard. The domain classifier of class c is fitted by
+    rank c % world_size on a uniform subsample of the class gathered from every rank, and the selected models
+    are exchanged so every rank weights its own validation rows. The DEV risk of a class is reduced from the
+    DevRiskAccumulator moments of every shard, so no rank ever holds the full validation features.
+    Call from every rank of an initialised group, e.g. with launch_local.
+    :param feature_network:
+    :param predict_network:
+    :param src_cls_list:
+    :param target_path:
+    :param val_cls_list:
+    :param class_num:
+    :param resize_size:
+    :param crop_size:
+    :param batch_size:
+    :param feature_cache: FeatureCache or directory shared by the ranks
+    :param error_type: validation error, see predict_errors
+    :param label_cache: directory caching the pseudolabels of every shard, see pseudo_label
+    :param weight_kwargs: keyword arguments for fit_importance_weight
+    :param max_train_rows: cap on the source plus target rows gathered to fit the classifier of a class, all of
+    them if None
+    :param seed: seed of the subsample
+    :return: the same loss on every rank
+    """
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    tracer = get_tracer()
+
+    with tracer.span('pseudo_label', rank=rank):
+        target_list = get_label_list(shard_list(open(target_path).readlines(), rank, world_size), predict_network,
+                                     resize_size, crop_size, batch_size, cache_dir=label_cache)
+    source_list = shard_list([line for cls_list in src_cls_list for line in cls_list], rank, world_size)
+    validation_list = shard_list([line for cls_list in val_cls_list for line in cls_list], rank, world_size)
+    src_rows = class_index(list_labels(source_list), class_num)
+    tar_rows = class_index(list_labels(target_list), class_num)
+    val_labels = list_labels(validation_list)
+    val_rows = class_index(val_labels, class_num)
+    transform = prep.image_train(resize_size=resize_size, crop_size=crop_size)
+
+    if isinstance(feature_cache, str):
+        feature_cache = FeatureCache(feature_cache)
+    feature_key = predict_key = None
+    if feature_cache is not None:
+        feature_key = network_hash(feature_network)
+        predict_key = feature_key if predict_network is feature_network else network_hash(predict_network)
+
+    with tracer.span('extract', rank=rank):
+        src_feature = extract_features(feature_network, source_list, transform, batch_size, cache=feature_cache,
+                                       network_key=feature_key)
+        tar_feature = extract_features(feature_network, target_list, transform, batch_size, cache=feature_cache,
+                                       network_key=feature_key)
+        if predict_network is feature_network:
+            val_feature, val_score = extract_features(feature_network, validation_list, transform, batch_size,
+                                                      output=(0, 1), cache=feature_cache, network_key=feature_key)
+        else:
+            val_feature = extract_features(feature_network, validation_list, transform, batch_size,
+                                           cache=feature_cache, network_key=feature_key)
+            val_score = extract_features(predict_network, validation_list, transform, batch_size, output=1,
+                                         cache=feature_cache, network_key=predict_key)
+    error = predict_errors(val_score, val_labels, error_type).numpy().reshape(-1, 1)
+
+    # the same keep probability on every rank keeps the gathered rows a uniform subsample of the class
+    counts = torch.tensor([len(src_rows[cls]) + len(tar_rows[cls]) for cls in range(class_num)], dtype=torch.int64)
+    dist.all_reduce(counts)
+    rng = np.random.RandomState(seed + rank)
+    owned = {}
+    with tracer.span('gather', rank=rank):
+        for cls in range(class_num):
+            keep = 1.0 if max_train_rows is None else min(1.0, float(max_train_rows) / max(1, int(counts[cls])))
+            src_keep = src_rows[cls][rng.rand(len(src_rows[cls])) < keep]
+            tar_keep = tar_rows[cls][rng.rand(len(tar_rows[cls])) < keep]
+            owner = cls % world_size
+            parts = [None] * world_size if rank == owner else None
+            dist.gather_object((src_feature[src_keep], tar_feature[tar_keep]), parts, dst=owner)
+            if rank == owner:
+                owned[cls] = (np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts]))
+
+    models = {}
+    for cls, (src, tar) in owned.items():
+        with tracer.span('fit_class', cls=cls, rank=rank):
+            models[cls] = fit_importance_weight(src, tar, **(weight_kwargs or {}))
+    owned = None
+    all_models = [None] * world_size
+    dist.all_gather_object(all_models, models)
+    models = dict(item for part in all_models for item in part.items())
+
+    with tracer.span('risk', rank=rank):
+        accumulators = [DevRiskAccumulator().update(models[cls](val_feature[val_rows[cls]]), error[val_rows[cls]])
+                        if len(val_rows[cls]) > 0 else DevRiskAccumulator() for cls in range(class_num)]
+        all_accumulators = [None] * world_size
+        dist.all_gather_object(all_accumulators, accumulators)
+        cross_val_loss = 0
+        for cls in range(class_num):
+            merged = DevRiskAccumulator()
+            for part in all_accumulators:
+                merged.merge(part[cls])
+            cross_val_loss = cross_val_loss + merged.risk()
+    return cross_val_loss/class_num